@@ -0,0 +1,209 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from functools import partial
+from memory import rss
+
+import synthetic
+
+
+# Benchmark of the rides and station ETL stages against synthetic trip data, run with python benchmark.py
+# Each header era is loaded into a new local SQLite warehouse, the geocoding is done offline from generated polygon files
+# The rows/sec and peak resident memory of each stage are printed and written to benchmark.json in the output folder
+# With --baseline, stages that got slower or use more memory than the baseline file are reported and the exit code is 1
+
+repo = os.path.dirname(os.path.abspath(__file__))
+
+
+# Records the time and peak resident memory of each stage, a background thread samples the memory while a stage runs
+class StageTimer:
+    def __init__(self, interval=0.005):
+        self.seconds = {}
+        self.peak = {}
+        self.added = {}
+        self.current_peak = None
+        self.interval = interval
+        threading.Thread(target=self.sample, daemon=True).start()
+
+    def sample(self):
+        while True:
+            if self.current_peak is not None:
+                self.current_peak = max(self.current_peak, rss())
+            time.sleep(self.interval)
+
+    @contextmanager
+    def stage(self, name, filename=None):
+        before = rss()
+        self.current_peak = before
+        start = time.perf_counter()
+        try:
+            yield {}  # Takes the place of the metrics event filled in by the stages
+        finally:
+            seconds = time.perf_counter() - start
+            peak = max(self.current_peak, rss())
+            self.current_peak = None
+            self.seconds[name] = self.seconds.get(name, 0) + seconds
+            self.peak[name] = max(self.peak.get(name, 0), peak)
+            self.added[name] = max(self.added.get(name, 0), peak - before)
+
+    # Returns the results of every stage for the given number of rows
+    def results(self, rows):
+        return {name: {'rows': rows, 'seconds': round(seconds, 3), 'rows_per_sec': round(rows / seconds) if seconds > 0 else None,
+                       'peak_mb': round(self.peak[name] / 1024 ** 2, 1), 'added_mb': round(self.added[name] / 1024 ** 2, 1)}
+                for name, seconds in self.seconds.items()}
+
+
+# Function to write the config.ini of the benchmark, pointing to a local warehouse, the generated polygons and the local station feed
+def write_config(out, args, geo, feed_url):
+    if not os.path.exists(os.path.join(out, 'auth')):
+        os.makedirs(os.path.join(out, 'auth'))
+    geo = {key: os.path.abspath(value) if key != 'mode' else value for key, value in geo.items()}
+    with open(os.path.join(out, 'auth', 'config.ini'), 'w') as f:
+        f.write('[warehouse]\nbackend = sqlite\npath = ./warehouse.sqlite\n'
+                f'schema = {os.path.join(repo, "create.sql")}\n\n'
+                '[geocoder]\n' + ''.join(f'{key} = {value}\n' for key, value in geo.items()) + '\n'
+                f'[etl]\nchunk_rows = {args.chunk_rows}\nbatch_seconds = {args.batch_seconds}\n\n'
+                f'[gbfs]\nstation_information = {feed_url}\n')
+
+
+def reset_warehouse(out):
+    if os.path.exists(os.path.join(out, 'warehouse.sqlite')):
+        os.remove(os.path.join(out, 'warehouse.sqlite'))
+
+
+# Function to run the transform and load stages of etl_rides.py over one zip file, the same way process_zip does
+# etl_rides calls its stage() function around read, clean, stations, dimensions and facts, it is replaced by the timer
+def bench_rides(E, zip_path, rows):
+    from dimensions import DimensionCache
+
+    timer = StageTimer()
+    E.stage = timer.stage
+    E.connection = E.connect()
+    E.cur = E.connection.cursor()
+    E.dim_cache = DimensionCache(E.cur)
+    E.loader = E.new_loader(E.connection, E.cur)
+    E.load_calendar()
+
+    # The load stage runs in the same thread here, so its time isn't hidden by the transforms running next to it
+    connection = E.connect()
+    fact_loader = E.new_loader(connection, connection.cursor())
+    for filename, offset, df, bad_records in E.read_rides(zip_path):
+        facts, bad_records = E.process_rides(df, filename)
+        with timer.stage('load'):
+            for name, batch, filename in facts:
+                fact_loader.load(name, batch, filename, commit=False)
+            connection.commit()
+    connection.close()
+    E.cur.close()
+    E.connection.close()
+    return timer.results(rows)
+
+
+# Function to run etl_station_city.py twice against the local station feed, once into an empty warehouse and once with moved stations
+# It runs in its own process like in production, the peak memory comes from the OS and is only measured on Unix
+def bench_stations(out, stations):
+    results = {}
+    moved = stations.copy()
+    moved.loc[moved.index % 10 == 0, 'station name'] += ' (moved)'
+    for name, feed in [('station insert', stations), ('station update', moved)]:
+        with open(os.path.join(out, 'station_information.json'), 'w') as f:
+            json.dump(synthetic.station_information(feed), f)
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(repo, 'etl_station_city.py')], cwd=out,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.stdout.read()
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            returncode, peak_mb = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1, usage.ru_maxrss / 1024  # ru_maxrss is in KB on Linux
+        else:
+            returncode, peak_mb = process.wait(), None
+        seconds = time.perf_counter() - start
+        print(output.decode(errors='replace').strip())
+        if returncode != 0:
+            raise RuntimeError(f'etl_station_city.py failed:\n{output.decode(errors="replace")}')
+        results[name] = {'rows': len(feed), 'seconds': round(seconds, 3), 'rows_per_sec': round(len(feed) / seconds),
+                         'peak_mb': round(peak_mb, 1) if peak_mb is not None else None, 'added_mb': None}
+    return results
+
+
+# Function to compare the results with a baseline, returns a line for each stage that got slower or uses more memory than the tolerance
+def regressions(results, baseline, tolerance):
+    found = []
+    for era, stages in results.items():
+        for name, result in stages.items():
+            before = baseline.get(era, {}).get(name)
+            if before is None:
+                continue
+            if before['rows_per_sec'] and result['rows_per_sec'] and result['rows_per_sec'] < before['rows_per_sec'] * (1 - tolerance):
+                found.append(f'{era} {name}: {result["rows_per_sec"]} rows/sec, was {before["rows_per_sec"]}')
+            if before['peak_mb'] and result['peak_mb'] and result['peak_mb'] > before['peak_mb'] * (1 + tolerance):
+                found.append(f'{era} {name}: {result["peak_mb"]}MB peak, was {before["peak_mb"]}MB')
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the ETL stages against synthetic trip data')
+    parser.add_argument('--eras', nargs='+', default=list(synthetic.eras), choices=list(synthetic.eras), help='header layouts to benchmark')
+    parser.add_argument('--rows', type=int, default=200000, help='rides in each zip file')
+    parser.add_argument('--stations', type=int, default=800, help='number of stations')
+    parser.add_argument('--dirty-rate', type=float, default=0.01, help='share of rides with bad station data or a missing birth year')
+    parser.add_argument('--chunk-rows', type=int, default=100000, help='chunk_rows of the rides ETL')
+    parser.add_argument('--batch-seconds', type=float, default=1, help='batch_seconds of the rides ETL')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='./bench', help='folder of the benchmark warehouse, files and results')
+    parser.add_argument('--baseline', help='benchmark.json of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown or memory growth reported as a regression')
+    args = parser.parse_args()
+
+    out = os.path.abspath(args.out)
+    if os.path.exists(out):
+        shutil.rmtree(out)
+    os.makedirs(out)
+
+    # The station feed is served from the output folder, like the Citibike GBFS feed
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(SimpleHTTPRequestHandler, directory=out))
+    SimpleHTTPRequestHandler.log_message = lambda *args: None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    write_config(out, args, synthetic.write_geo(os.path.join(out, 'geo')),
+                 f'http://127.0.0.1:{server.server_address[1]}/station_information.json')
+
+    # etl_rides reads ./auth/config.ini when it is imported, so it is imported from the output folder
+    os.chdir(out)
+    import etl_rides
+
+    stations = synthetic.make_stations(args.stations, args.seed)
+    results = {}
+    for era in args.eras:
+        month = era.replace('-', '')
+        trips = synthetic.make_trips(stations, args.rows, era, era, args.dirty_rate, args.seed)
+        zip_path = synthetic.write_zip(os.path.join(out, f'{month}-citibike-tripdata.zip'), {f'{month}-citibike-tripdata.csv': trips})
+        del trips
+        reset_warehouse(out)
+        print(f'\nBenchmarking {era} with {args.rows} rides')
+        results[era] = bench_rides(etl_rides, zip_path, args.rows)
+    reset_warehouse(out)
+    results['stations'] = bench_stations(out, stations)
+    server.shutdown()
+
+    print(f'\n{"":10} {"stage":15} {"rows/sec":>12} {"seconds":>9} {"peak MB":>9} {"added MB":>9}')
+    for era, stages in results.items():
+        for name, result in stages.items():
+            values = ['' if result[key] is None else result[key] for key in ['rows_per_sec', 'seconds', 'peak_mb', 'added_mb']]
+            print(f'{era:10} {name:15} {values[0]:>12} {values[1]:>9} {values[2]:>9} {values[3]:>9}')
+    with open(os.path.join(out, 'benchmark.json'), 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f'Regression: {line}')
+        sys.exit(1 if found else 0)
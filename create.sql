@@ -8,9 +8,23 @@ Station_longitude	number,
 Zipcode				varchar2(12),
 Neighborhood		varchar2(50),
 Borough				varchar2(50),
+Row_Hash			varchar2(32),
 primary key(Station_ID)
 );
 
+-- Snapshot of the GBFS station feed, merged into Station_Dimension by etl_station_city.py
+CREATE GLOBAL TEMPORARY TABLE Station_Staging(
+Station_ID			number not null,
+Station_name		varchar2(70),
+Station_latitude	number,
+Station_longitude	number,
+Zipcode				varchar2(12),
+Neighborhood		varchar2(50),
+Borough				varchar2(50),
+Row_Hash			varchar2(32),
+primary key(Station_ID)
+) ON COMMIT DELETE ROWS;
+
 
 CREATE TABLE User_Dimension(
 User_ID				number GENERATED BY DEFAULT ON NULL AS IDENTITY,
@@ -67,7 +81,28 @@ foreign key(Station_ID_E) references Station_Dimension(Station_ID),
 foreign key(Date_ID) references Date_Dimension(Date_ID)
 );
 
+-- Changes of the GBFS station_status feed, one row each time a station's bikes, docks or renting status changed
+-- Polled is the last_updated time of the feed the change was found in, and Reported the last_reported time of the station
+-- Both are in seconds since 1970-01-01 UTC, a station can change more than once with the same last_reported time
+CREATE TABLE Station_Status_Fact(
+Station_ID			number,
+Polled				number,
+Reported			number,
+Bikes_Available		number,
+Docks_Available		number,
+Is_Renting			number,
+primary key(Station_ID, Polled)
+);
+
 CREATE TABLE data_processed (
 filename		varchar2(50),
 bad_records		number,
 primary key (filename));
+
+CREATE TABLE data_checkpoint (
+filename		varchar2(50),
+csv_filename	varchar2(100),
+row_offset		number,
+row_count		number,
+bad_records		number,
+primary key (filename, csv_filename, row_offset));
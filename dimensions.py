@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+import zlib
+
+
+# In-process cache of the keys already loaded into the dimension tables and TABLE data_processed
+# The tables are read once when the cache is created, then rows are added as they are inserted,
+# so each file only sends new keys to the DB instead of re-selecting every table
+# Each dimension is a dict of key -> value, the value being the last column of its query (None if there is one column)
+# With shared=True other processes are inserting into the same tables, so the missed keys are selected again before they are reported as new
+class DimensionCache:
+    queries = {
+        'processed': "SELECT filename FROM admin.data_processed",
+        'stations': "SELECT station_id, borough FROM admin.station_dimension",
+        'dates': "SELECT date_id FROM admin.date_dimension",
+        'routes': "SELECT routepath_id, route_path_bor FROM admin.route_dimension",
+        'users': "SELECT usertype, birth_year, age, gender, user_id FROM admin.user_dimension",
+        'user_ids': "SELECT user_id FROM admin.user_dimension",
+    }
+    # Key columns of each query, used to select only some of its keys
+    key_columns = {
+        'processed': ['filename'],
+        'stations': ['station_id'],
+        'dates': ['date_id'],
+        'routes': ['routepath_id'],
+        'users': ['usertype', 'birth_year', 'age', 'gender'],
+        'user_ids': ['user_id'],
+    }
+    fetch_size = 200  # Keys per query, Oracle allows at most 1,000 values in an IN list
+
+    def __init__(self, cur, shared=False):
+        self.cur = cur
+        self.shared = shared
+        self.keys = {}
+        self.hits = dict.fromkeys(self.queries, 0)
+        self.misses = dict.fromkeys(self.queries, 0)
+        for name in self.queries:
+            self.reload(name)
+
+    def reload(self, name):
+        self.keys[name] = {}
+        self.add(name, self.cur.execute(self.queries[name]))
+
+    # Function to select only the given keys of a dimension and add the ones found, instead of reloading the whole table
+    def fetch(self, name, keys):
+        columns = self.key_columns[name]
+        keys = [tuple(key) if len(columns) > 1 else (key,) for key in keys]
+        for start in range(0, len(keys), self.fetch_size):
+            batch = keys[start:start + self.fetch_size]
+            values = [value.item() if hasattr(value, 'item') else value for key in batch for value in key]  # numpy values can't be bound
+            binds = [f"({', '.join(f':{i * len(columns) + j + 1}' for j in range(len(columns)))})" for i in range(len(batch))]
+            if len(columns) > 1:
+                where = f"({', '.join(columns)}) IN ({', '.join(binds)})"
+            else:
+                where = f"{columns[0]} IN ({', '.join(bind.strip('()') for bind in binds)})"
+            rows = self.cur.execute(f'{self.queries[name]} WHERE {where}', values).fetchall()
+            self.add(name, rows)
+            if name == 'users':  # The user_id of a user selected again is also a key of user_ids
+                self.add('user_ids', [(row[-1],) for row in rows])
+
+    # Adds rows in the column order of the dimension's query
+    def add(self, name, rows):
+        dimension = self.keys[name]
+        for row in rows:
+            if len(row) == 1:
+                dimension[row[0]] = None
+            elif len(row) == 2:
+                dimension[row[0]] = row[1]
+            else:
+                dimension[tuple(row[:-1])] = row[-1]
+
+    def __contains__(self, item):
+        name, key = item
+        return key in self.keys[name]
+
+    # Returns the keys that are not in the dimension yet, and counts the hits and misses
+    def missing(self, name, keys):
+        keys = set(keys)
+        new = [key for key in keys if key not in self.keys[name]]
+        if new and self.shared:
+            self.fetch(name, new)
+            new = [key for key in new if key not in self.keys[name]]
+        self.hits[name] += len(keys) - len(new)
+        self.misses[name] += len(new)
+        return new
+
+    # Returns the dimension as a df with the key and value columns, used to merge the dimension values into the rides df
+    def frame(self, name, columns):
+        rows = [(*key, value) if isinstance(key, tuple) else (key, value) for key, value in self.keys[name].items()]
+        return pd.DataFrame(rows, columns=columns)
+
+    def stats(self):
+        return ', '.join(f'{name} {self.hits[name]} hits/{self.misses[name]} misses' for name in self.queries)
+
+
+# Function to compute a deterministic User_ID from the natural key of User_Dimension (usertype, birth year, gender)
+# The usertype is hashed with CRC32, so user types from newer files don't need a lookup table
+# user_id = (crc32(usertype) + 1) * 100000 + birth year * 10 + gender, which stays above the small ids made by the IDENTITY column
+def natural_user_ids(usertype, birth_year, gender):
+    codes = {value: zlib.crc32(str(value).encode()) + 1 for value in usertype.unique()}
+    return usertype.map(codes).astype('int64') * 100000 + birth_year.astype('int64') * 10 + gender.astype('int64')
+
+
+# Function to compute a numeric RoutePath_ID from the start and end station ids, used with route_keys = stations
+# Station ids are scaled by 100, so the decimal ids of the files from 2021-02 (e.g. 6140.05) stay unique
+# route id = start id * 100 * 10^7 + end id * 100, which fits in an int64 for station ids below 100000
+def route_ids(start_ids, end_ids):
+    start = np.round(np.asarray(start_ids, dtype='float64') * 100).astype('int64')
+    end = np.round(np.asarray(end_ids, dtype='float64') * 100).astype('int64')
+    return start * 10 ** 7 + end
+
+
+# Function to build the Date_Dimension rows of the given days, in the column order of loader.tables['dates']
+# Ride_Week is the ISO week number
+def calendar(days):
+    days = pd.DatetimeIndex(days)
+    return pd.DataFrame({'date_id': date_ids(days),
+                         'day': days.day,
+                         'week': days.isocalendar().week.to_numpy(dtype='int64'),
+                         'month': days.month,
+                         'year': days.year,
+                         'weekday': days.day_name()})
+
+
+# Function to compute the Date_ID (YYYYMMDD as a number) of datetime64 values with integer arithmetic instead of strftime
+def date_ids(timestamps):
+    days = np.asarray(timestamps, dtype='datetime64[D]')
+    months = days.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]')
+    return (years.astype('int64') + 1970) * 10000 + (months.astype('int64') % 12 + 1) * 100 + (days - months).astype('int64') + 1
@@ -0,0 +1,118 @@
+import json
+import os
+import requests
+import time
+import zlib
+
+from retrying import retry
+from zipfile import BadZipFile, ZipFile
+
+
+# Local store of the zip files downloaded from the Citibike bucket
+# Each file is saved with a .json sidecar holding the ETag, Last-Modified and size sent by S3
+# A file that is already in the store is revalidated with a conditional GET, so it is only downloaded again if S3 has a new version
+# With keep=False the zip files are removed once they are loaded, and only kept around to retry or resume a download
+class ArchiveStore:
+    def __init__(self, path='./spool', keep=False, chunk_size=1024 * 1024):
+        self.path = path
+        self.keep = keep
+        self.chunk_size = chunk_size
+        self.session = requests.Session()
+
+    def file_path(self, url):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        return os.path.join(self.path, url.rstrip('/').split('/')[-1])
+
+    # Returns the saved validators of a file, or an empty dict if it isn't in the store
+    def metadata(self, url):
+        meta_path = self.file_path(url) + '.json'
+        if not os.path.exists(meta_path) or not os.path.exists(self.file_path(url)):
+            return {}
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def save_metadata(self, url, response):
+        meta = {'url': url,
+                'etag': response.headers.get('ETag', '').strip('"'),
+                'last_modified': response.headers.get('Last-Modified', ''),
+                'size': os.path.getsize(self.file_path(url)),
+                'fetched_at': time.time()}
+        with open(self.file_path(url) + '.json.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.file_path(url) + '.json.tmp', self.file_path(url) + '.json')
+        return meta
+
+    # Headers of a conditional GET, S3 answers 304 Not Modified if the saved version is still current
+    def conditional_headers(self, meta):
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = f'"{meta["etag"]}"'
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    # Function to download a zip file into the store, or revalidate the copy already there
+    # An interrupted download leaves a .part file behind, the next attempt resumes it with a HTTP Range request
+    # The zip CRCs are checked after each download and again when a stored copy is reused, a corrupt file is deleted and downloaded again by the retry
+    # Returns the local path and the saved metadata
+    @retry(wait_fixed=30000, stop_max_attempt_number=3)
+    def fetch(self, url):
+        local_path = self.file_path(url)
+        part_path = local_path + '.part'
+        meta = self.metadata(url)
+        if meta:
+            with self.session.get(url, headers=self.conditional_headers(meta), stream=True, timeout=60) as response:
+                if response.status_code == 304 and meta['size'] == os.path.getsize(local_path):
+                    verify_zip(local_path)  # The copy may have been damaged on disk since it was downloaded
+                    return local_path, meta
+                if response.status_code == 200:  # S3 has a new version, start over
+                    return self.download(url, response, 'wb')
+
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset > 0 else {}
+        with self.session.get(url, headers=headers, stream=True, timeout=60) as response:
+            if response.status_code == 416:  # The range starts past the end of the file, the .part file can't be trusted
+                os.remove(part_path)
+                raise IOError(f'Invalid partial download of {url}, restarting')
+            return self.download(url, response, 'ab' if response.status_code == 206 else 'wb')
+
+    def download(self, url, response, mode):
+        local_path = self.file_path(url)
+        part_path = local_path + '.part'
+        response.raise_for_status()
+        if response.status_code == 206:
+            expected_size = int(response.headers['Content-Range'].split('/')[-1])
+        else:  # The server ignored the Range header and sent the whole file
+            expected_size = int(response.headers.get('Content-Length', -1))
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=self.chunk_size):
+                f.write(chunk)
+
+        if expected_size >= 0 and os.path.getsize(part_path) != expected_size:
+            raise IOError(f'Incomplete download of {url}, {os.path.getsize(part_path)} of {expected_size} bytes')
+        verify_zip(part_path)
+        os.replace(part_path, local_path)
+        return local_path, self.save_metadata(url, response)
+
+    # Function to remove a zip file once it is loaded, unless the store keeps them
+    def remove(self, url):
+        if self.keep:
+            return
+        for path in [self.file_path(url), self.file_path(url) + '.json']:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+# Function to check the CRC of every member of a zip file, deleting the file if one doesn't match
+def verify_zip(path):
+    try:
+        with ZipFile(path) as thezip:
+            bad_member = thezip.testzip()
+    except BadZipFile:
+        bad_member = '(zip directory)'
+    except (zlib.error, EOFError):  # Compressed data that is damaged can fail before its CRC is compared
+        bad_member = '(compressed data)'
+    if bad_member is not None:
+        os.remove(path)
+        raise IOError(f'CRC check failed for {bad_member} in {path}, downloading it again')
@@ -1,503 +1,744 @@
 #%%
+import argparse
 import configparser
-import cx_Oracle
 import io
-import json
+import mmap
+import multiprocessing
 import numpy as np
-import os
 import pandas as pd
 import requests
+import time
 
-from bs4 import BeautifulSoup
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
-from retrying import retry
+from dimensions import DimensionCache, calendar, date_ids, natural_user_ids, route_ids
+from downloads import ArchiveStore
+from geocode import GeocodeCache, GeocodeClient, OfflineGeocoder
+from listing import list_bucket, trip_zips
+from loader import BulkLoader
+from memory import MemoryBudget, downcast, parse_size
+from metrics import Metrics
+from pipeline import Drain, prefetch
+from profiling import Profiler
+from schemas import detect_schema, ride_columns
+from staging import StagingCache
+from warehouse import get_warehouse
 from zipfile import ZipFile
 
 
 start_time = datetime.now()
 
-# Connect to Oracle Autonomous Data Warehouse using Wallet and local config file for user/pw storage
-# If using a different Oracle Client version, update the below path as needed
-cx_Oracle.init_oracle_client(lib_dir=".venv/instantclient_19_10")
+# Connect to Oracle Autonomous Data Warehouse, or the local SQLite warehouse, using the local config file for user/pw storage
 config = configparser.ConfigParser()
 config.read('./auth/config.ini')
-username = config.get('oracle', 'username')
-password = config.get('oracle', 'password')
-connection = cx_Oracle.connect(username, password, 'dwaproject_high')
-cur = connection.cursor()
-
-# Function to download and extract zip files into memory
-def download_extract_zip(url):
-    response = requests.get(url)
-    with ZipFile(io.BytesIO(response.content)) as thezip:
+warehouse = get_warehouse(config)
+
+# Each process opens its own connection, a DB connection can't be shared between worker processes
+def connect():
+    return warehouse.connect()
+
+# ETL settings are optional, the defaults are used if the [etl] section is missing from config.ini
+download_mode = config.get('etl', 'download_mode', fallback='stream')  # stream or memory
+spool_dir = config.get('etl', 'spool_dir', fallback='./spool')
+keep_zips = config.getboolean('etl', 'keep_zips', fallback=False)  # Keep the downloaded zip files in spool_dir once they are loaded
+chunk_rows = config.getint('etl', 'chunk_rows', fallback=500000)  # 0 reads each CSV file in one go
+workers = config.getint('etl', 'workers', fallback=1)  # Number of zip files processed at the same time
+user_keys = config.get('etl', 'user_keys', fallback='identity')  # identity or natural
+route_keys = config.get('etl', 'route_keys', fallback='names')  # names or stations, stations needs the tables from route_keys.sql
+batch_seconds = config.getfloat('etl', 'batch_seconds', fallback=5)  # Target time of each batch insert, used to size the batches
+prefetch_zips = config.getint('etl', 'prefetch_zips', fallback=1)  # Zip files downloaded ahead of the one being transformed
+queue_batches = config.getint('etl', 'queue_batches', fallback=4)  # Fact batches waiting for the load stage before the transform stage blocks
+calendar_start = config.get('etl', 'calendar_start', fallback='2013-06-01')  # First day of Date_Dimension, the first trip data is from 2013-06
+calendar_end = config.get('etl', 'calendar_end', fallback=f'{datetime.now().year}-12-31')
+listing_start = config.get('etl', 'listing_start', fallback='2018-01')  # Months of trip data loaded from the bucket, as YYYY-MM
+listing_end = config.get('etl', 'listing_end', fallback='2021-12')  # Empty loads every month from listing_start onwards
+
+# Lock held while new dimension keys are looked up and inserted, replaced by a shared lock in the worker processes
+dim_lock = nullcontext()
+
+# Function run once in each worker process to open its own DB connection and dimension cache
+def init_worker(lock, max_memory, profile_dir, memory_frames):
+    global budget, connection, cur, dim_cache, dim_lock, loader
+    budget = MemoryBudget(max_memory) if max_memory else None
+    metrics.take()  # A forked worker starts with a copy of the totals of the main process, which already counts them
+    metrics.profiler = Profiler(profile_dir, memory_frames) if profile_dir else None
+    connection = connect()
+    cur = connection.cursor()
+    dim_cache = DimensionCache(cur, shared=True)
+    loader = new_loader(connection, cur)
+    dim_lock = lock
+
+# Memory budget of the process, set with --max-memory
+budget = None
+
+# Durations, row counts and errors of every stage are recorded as JSON events, and optionally exported for Prometheus
+metrics = Metrics.from_config(config, 'rides')
+
+# Function to time a stage of the ETL and record it in the metrics, and measure the memory it adds when running with a memory budget
+# Yields the metrics event of the stage, for the caller to fill in its rows, bytes and errors
+@contextmanager
+def stage(name, filename=None):
+    with budget.stage(name) if budget is not None else nullcontext():
+        with metrics.stage(name, filename) as event:
+            yield event
+
+# Function to create a batch loader, with a memory budget each batch of bind data is limited to a share of it
+def new_loader(connection, cur):
+    return BulkLoader(warehouse, connection, cur, batch_seconds, max_bytes=budget.batch_bytes() if budget is not None else None, metrics=metrics)
+
+# Function to extract zip files downloaded into memory
+def extract_zip(content):
+    with ZipFile(io.BytesIO(content)) as thezip:
         for zipinfo in thezip.infolist():
             with thezip.open(zipinfo) as thefile:
                 yield zipinfo.filename, thefile
 
-# Function to remove bad records from the batch SQL statement
-# Writes a log file to identify bad records for review
-def remove_bad_obj(data, batcherror, log_filename, current_file):
-    if len(batcherror) < 101:
-        connection.rollback()  # Roll back any transactions made prior to error
-        data_count = len(data)
-        if not os.path.exists('./log'):
-            os.makedirs('./log')
-        
-        # Write a log file with the SQL error and the offset positions
-        f = open(f'./log/{log_filename}.txt', 'a')
-        for error in batcherror:
-            f.write(f'{datetime.now()}, {current_file}, {error.message}, "at row offset, {error.offset}\n')
-        f.close()
-        print(f'Log file written with {len(batcherror)} errors to ./log/{log_filename}.txt')
-        
-        bad_obj = [obj.offset for obj in batcherror] # Get a list of positional values where an error was encountered
-        bad_obj.reverse() # Since offset is positional, the code is reversed to start from high to low
-        for obj in bad_obj:
-            data.pop(obj)  # Remove the records 
-        if log_filename == 'new bikes':
-            sql_insert_bikes(data, log_filename, current_file, False)  # Rerun the SQL statement
-            connection.commit()  # Commit the batch insert to the DB
-            print(f'{data_count - len(batcherror)} bike usages have been inserted with errors removed.')
-        elif log_filename == 'new ridership':
-            sql_insert_ridership(data, log_filename, current_file, False)  # Rerun the SQL statement
-            connection.commit()  # Commit the batch insert to the DB
-            print(f'{data_count - len(batcherror)} riderships have been inserted with errors removed.')
-        elif log_filename == 'historical stations':
-            sql_insert_station(data, log_filename, current_file, False)  # Rerun the SQL statement
-            connection.commit()  # Commit the batch insert to the DB
-            print(f'{data_count - len(batcherror)} stations have been inserted with errors removed.')
-        elif log_filename == 'dates':
-            sql_insert_date(data, log_filename, current_file, False)  # Rerun the SQL statement
-            connection.commit()  # Commit the batch insert to the DB
-            print(f'{data_count - len(batcherror)} dates have been inserted with errors removed.')
-        elif log_filename == 'users':
-            sql_insert_user(data, log_filename, current_file, False)  # Rerun the SQL statement
-            connection.commit()  # Commit the batch insert to the DB
-            print(f'{data_count - len(batcherror)} users have been inserted with errors removed.')
-        elif log_filename == 'new routes':
-            sql_insert_route(data, log_filename, current_file, False)  # Rerun the SQL statement
-            connection.commit()  # Commit the batch insert to the DB
-            print(f'{data_count - len(batcherror)} users have been inserted with errors removed.')
-    else:
-        f = open(f'./log/{log_filename}.txt', 'a')
-        f.write(f'{datetime.now()}, {current_file}, Over 100 errors, will skip this batch \n')
-        f.close()
-        print(f'Over 100 errors in {current_file} with {log_filename}, will skip this batch')
-
-    
-# The SQL insert statement is wrapped in a function to use the retry function
-# The Oracle DB can return an error ORA-30036: unable to extend segment by 8 in undo
-# This error is caused by the Oracle DB running out of tablespace in the undo table
-# If an error is encountered, the code will wait 30 seconds before retrying and stop after 3 tries
-# By allowing time to pass, it will allow the existing transaction to complete, so the entire batch is not lost
-# A parameter called first_round is added to prevent some messages from being printed
-# Since the sql_insert functions and remove_bad_obj are recursively nested, the flag is used to determine if it is at the top level
-@retry(wait_fixed=30000, stop_max_attempt_number=3)
-def sql_insert_bikes(data, log_filename, current_file, first_round = True):
-    cur.executemany("""
-        INSERT INTO admin.bikeusage_fact (bike_id, routepath_id, station_id_s, station_id_e, date_id, duration)
-        VALUES(:1, :2, :3, :4, :5, :6) """, data, batcherrors=True)
-    bad_data = len(cur.getbatcherrors())
-    if bad_data == 0 and first_round:
-        connection.commit()
-        print(f'{len(data)} bike usage have been inserted without error.')
-    elif bad_data > 0:
-        remove_bad_obj(data, cur.getbatcherrors(), log_filename, current_file)
-    else:
-        pass
-    return bad_data
-
-@retry(wait_fixed=30000, stop_max_attempt_number=3)
-def sql_insert_ridership(data, log_filename, current_file, first_round = True):
-    cur.executemany("""
-        INSERT INTO admin.ridership_fact (user_id, station_id_s, station_id_e, date_id, duration)
-        VALUES(:1, :2, :3, :4, :5) """, data, batcherrors=True)
-    bad_data = len(cur.getbatcherrors())
-    if bad_data == 0 and first_round:
-        connection.commit()
-        print(f'{len(data)} ridership have been inserted without error.')
-    elif bad_data > 0:
-        remove_bad_obj(data, cur.getbatcherrors(), log_filename, current_file)
-    else:
-        pass
-    return bad_data
-
-
-@retry(wait_fixed=30000, stop_max_attempt_number=3)
-def sql_insert_station(data, log_filename, current_file):
-    cur.executemany("""
-        INSERT into admin.station_dimension (station_id, station_name, station_latitude, station_longitude, zipcode, neighborhood, borough)
-        VALUES(:1, :2, :3, :4, :5, :6, :7) """, data, batcherrors=True)
-    if len(cur.getbatcherrors()) == 0:
-        connection.commit()
-        if len(data) > 0:
-            print(f'{len(data)} stations have been inserted.')
-    else:
-        remove_bad_obj(data, cur.getbatcherrors(), log_filename, current_file)
-
-@retry(wait_fixed=30000, stop_max_attempt_number=3)
-def sql_insert_date(data, log_filename, current_file):
-    cur.executemany("""
-        INSERT into admin.date_dimension (Date_ID, Ride_Day, Ride_Week, Ride_Month, Ride_Year, Weekdays)
-        VALUES(:1, :2, :3, :4, :5, :6) """, data, batcherrors=True)
-    if len(cur.getbatcherrors()) == 0:
-        connection.commit()
-        if len(data) > 0:
-            print(f'{len(data)} dates have been inserted.')
-    else:
-        remove_bad_obj(data, cur.getbatcherrors(), log_filename, current_file)
-
-@retry(wait_fixed=30000, stop_max_attempt_number=3)
-def sql_insert_user(data, log_filename, current_file):
-    cur.executemany("""
-        INSERT into admin.user_dimension (usertype, birth_year, age, gender, gendername)
-        VALUES(:1, :2, :3, :4, :5) """, data, batcherrors=True)
-    if len(cur.getbatcherrors()) == 0:
-        connection.commit()
-        if len(data) > 0:
-            print(f'{len(data)} users have been inserted.')
-    else:
-        remove_bad_obj(data, cur.getbatcherrors(), log_filename, current_file)
-
-@retry(wait_fixed=30000, stop_max_attempt_number=3)
-def sql_insert_route(data, log_filename, current_file):
-    cur.executemany("""
-        INSERT into admin.route_dimension (routepath_id, route_path_bor)
-        VALUES(:1, :2) """, data, batcherrors=True)
-    if len(cur.getbatcherrors()) == 0:
-        connection.commit()
-        if len(data) > 0:
-            print(f'{len(data)} routes have been inserted.')
-    else:
-        remove_bad_obj(data, cur.getbatcherrors(), log_filename, current_file)
-
-# Load Google Map API key
-gg_api = config.get('google', 'api')
-gg_url = 'https://maps.googleapis.com/maps/api/geocode/json'
-
-
-# Gets list of zip file names from the Citibike website
-url = "https://s3.amazonaws.com/tripdata/"
-r = requests.get(url)
-soup = BeautifulSoup(r.text, features='html.parser')
-data_files = soup.find_all('key')
-zip_files = []
-try:
-    # For this project, the data was limited to only NYC data and years starting from 2018
-    for file in range(len(data_files) - 1):
-        if 'JC' not in data_files[file].get_text():
-            if '2021' in data_files[file].get_text() or '2020' in data_files[file].get_text() or '2019' in data_files[file].get_text() or '2018' in data_files[file].get_text():
-                zip_files.append(data_files[file].get_text())
-except Exception as e:
-    print(f"Failed {e}")
-
-# Check if files to be downloaded has already been processed
-processed = [filename for filename in cur.execute("SELECT filename FROM admin.data_processed")]
-processed = [filename for tup in processed for filename in tup] # Convert a list of tuples to list of string
-new_zips = sorted(set(zip_files) - set(processed) - set(['201307-201402-citibike-tripdata.zip']), reverse = True) # 201307-201402-citibike-tripdata.zip has its contents extracted already, remove duplicate effort
-
-print(f'Identified {len(new_zips)} new file(s).')
-
-total_records = 0
-
-# Loop to visit all new identified links on Citibike data website
-for zip_filename in new_zips:
-    
-    # Downloads and extracts the zip files into memory
-    extracted = download_extract_zip(url + zip_filename)
-
-    
-    # Loop that goes through all files in the zip extract
-    for file in extracted:
-        # This code will update the processed list to make sure duplicate files are not reprocessed
-        processed = [filename for filename in cur.execute("SELECT filename FROM admin.data_processed")]
-        processed = [filename for tup in processed for filename in tup]  # Convert a list of tuples to list of string
-
-        filename = file[0]
-        fileobj = file[1]
-        
-        if filename.endswith(".csv") and filename not in processed and 'MACOSX' not in filename:  # Only process valid csv files not found in DB TABLE data_processed
-            print(f'\nProcessing {filename}')
-            
-            # Get list of available stations in DB TABLE station_dimension
-            # This code is inside the loop after each zip file download to get an updated list of available stations in the DB
-            avail_station_id = [id for id in cur.execute("SELECT station_id FROM admin.station_dimension")]
-            avail_station_id = [id for tup in avail_station_id for id in tup]  # Convert a list of tuples to list of numbers
-            bad_records = 0
-
-            # Creates an empty dataframe to store station information
-            station_schema = ['station id', 'station name', 'station longitude', 'station latitude']
-            stations = pd.DataFrame(columns=station_schema)
-
-            # Read the file object from memory and load into a Pandas df
-            df = pd.read_csv(fileobj, encoding='cp1252')
-            original_row_count = df.shape[0]
-            total_records += original_row_count
-            # Standardizes the column names for all CSV files
-            df = df.rename(columns=({'Trip Duration':'tripduration',
-                                    'Start Time':'starttime',
-                                    'Stop Time':'stoptime',
-                                    'Start Station ID':'start station id',
-                                    'Start Station Name':'start station name',
-                                    'Start Station Latitude':'start station latitude',
-                                    'Start Station Longitude':'start station longitude',
-                                    'End Station ID':'end station id',
-                                    'End Station Name':'end station name',
-                                    'End Station Latitude':'end station latitude',
-                                    'End Station Longitude':'end station longitude',
-                                    'Bike ID':'bikeid',
-                                    'User Type':'usertype',
-                                    'Birth Year':'birth year',
-                                    'Gender': 'gender'}))
-            
-            # Cleans NaN data
-            df['usertype'].fillna('', inplace=True)
-            df['birth year'] = pd.to_numeric(df['birth year'], errors='coerce') # Forces \N values to NaN
-            df['birth year'].fillna(1800, inplace=True) # Changes NaN to 1800
-            miss_start = sum(df['start station id'].isna())
-            if miss_start > 0:
-                df.dropna(subset=['start station id'], inplace=True)
-            miss_end = sum(df['end station id'].isna())
-            if miss_end > 0:
-                df.dropna(subset=['end station id'], inplace=True)
-
-            # There are some dummy station information, where lat/long is 0
-            # These records were dropped
-            df = df[df['start station longitude'] != 0]
-            df = df[df['start station latitude'] != 0]
-            df = df[df['end station longitude'] != 0]
-            df = df[df['end station latitude'] != 0]
-            cleaned_row_count = df.shape[0]
-            bad_stations = original_row_count - cleaned_row_count
-            bad_records += bad_stations
-            if bad_stations > 0:
-                print(f'{bad_stations} rides were dropped due to bad station data.')
-
-            # Strips milliseconds from timestamp
-            if (df["starttime"].str.len() > 19).any():
-                df["starttime"] = df["starttime"].str.slice(stop=-5)
-            if (df["stoptime"].str.len() > 19).any():
-                df["stoptime"] = df["stoptime"].str.slice(stop=-5)
-            
-
-            # Standardizes all date format to YYYY-MM-DD
-            if (df['starttime'].str.contains('/')).any():
-                reform_date = df['starttime'].str.split(' ').str[0]
-                df['starttime'] = pd.to_datetime(reform_date).dt.strftime('%Y-%m-%d') #+ ' ' + df['starttime'].str.split(' ').str[1] # the time is excluded, uncomment if needed
-                reform_date = df['stoptime'].str.split(' ').str[0]
-                df['stoptime'] = pd.to_datetime(reform_date).dt.strftime('%Y-%m-%d') #+ ' ' + df['stoptime'].str.split(' ').str[1] # the time is excluded, uncomment if needed
-
-
-            # Historical/defunct stations are not available in the Citibike station JSON feed
-            # This bit of code will look at stations not in the DB TABLE station and insert the missing station information
-            # Current station information will be processed by etl_station_city.py
-            
-            # Build a stations df with unique, but defunct records
-            start_station = df.iloc[:, 3:7].drop_duplicates()
-            start_station.columns = station_schema
-            end_station = df.iloc[:, 7:11].drop_duplicates()
-            end_station.columns = station_schema
-            frames = [stations, start_station, end_station]
-            stations = pd.concat(frames)
-            stations.drop_duplicates(subset = 'station id', inplace = True, keep = 'last', ignore_index = True)
-            stations = stations.dropna()
-            stations = stations[~stations['station id'].isin(avail_station_id)]  # Filter out station id that already exists in the DB station
-            
-            # Use Google Reverse Geocode API and run sql_insert_station if there are historical stations to add
-            if stations.shape[0] > 0:
-                # Create a list of lat/long pair
-                coord = (stations['station longitude'].astype(str) + ',' + stations['station latitude'].astype(str)).tolist()
-                filter_results = 'postal_code|neighborhood|sublocality'
-                zipcodes = []
-
-                city_df = pd.DataFrame(columns=['zipcode', 'neighborhood', 'borough'])
-
-                # Loop goes through each lat/long pair to send a get request to Google Map reverse geocode API
-                # This will try to match a zip code to the lat/long pair            
-
-                for row, pair in enumerate(coord):
-                    # Google Map reverse geocode API URL
-                    gg_r = requests.get(f'{gg_url}?latlng={pair}&key={gg_api}&results={filter_results}')
-                    geocode = json.loads(gg_r.text)
-
-
-                    # These are flag variables created to check if data is found in the Google API request
-                    postalcode = False
-                    neighborhood = False
-                    borough = False
-                    all_flag = False
-
-
-                    # A temp dataframe is used to store the relevant information
-                    # If the zip code is not in the city_df, then it will be appended with the temp_df
-                    temp_df = pd.DataFrame(columns=['zipcode', 'neighborhood', 'borough'])
-                    # The nested for loop is used to populate the zip code column in station_df, which will be used to populate the DB table station
-                    # It is also used to create the city_df, which will be used to populate the DB table city
-                    for data in geocode['results']:
-                        for add_comp in data['address_components']:
-                            if 'postal_code' in add_comp['types'] and not postalcode:
-                                postalcode = True
-                                zipcodes.append(add_comp['long_name'])
-                                temp_df.at[0,'zipcode'] = add_comp['long_name']
-                                if city_df['zipcode'].isin([add_comp['long_name']]).any():
-                                    all_flag = True
-                                    break
-                            elif 'neighborhood' in add_comp['types'] and not neighborhood:
-                                neighborhood = True
-                                temp_df.at[0,'neighborhood'] = add_comp['long_name']
-                            elif 'sublocality' in add_comp['types'] and not borough:
-                                borough = True
-                                temp_df.at[0, 'borough'] = add_comp['long_name']
-                            if postalcode and neighborhood and borough:
+# ZipFile expects a seekable file object, mmap only gained seekable() in Python 3.13
+class MappedFile(mmap.mmap):
+    def seekable(self):
+        return True
+
+# Function to extract the members of a downloaded zip file from a memory-mapped file
+# Only the pages being read are held in memory, rather than the entire archive
+def extract_zip_spooled(spool_path):
+    with open(spool_path, 'rb') as f, MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with ZipFile(mm) as thezip:
+            for zipinfo in thezip.infolist():
+                with thezip.open(zipinfo) as thefile:
+                    yield zipinfo.filename, thefile
+
+# Function to standardize the column names and drop rides with bad station data
+# Returns the cleaned df and the number of rides dropped
+def clean_rides(df):
+    original_row_count = df.shape[0]
+    bad_records = 0
+
+    # Standardizes the column names for all CSV files
+    df = df.rename(columns=({'Trip Duration':'tripduration',
+                            'Start Time':'starttime',
+                            'Stop Time':'stoptime',
+                            'Start Station ID':'start station id',
+                            'Start Station Name':'start station name',
+                            'Start Station Latitude':'start station latitude',
+                            'Start Station Longitude':'start station longitude',
+                            'End Station ID':'end station id',
+                            'End Station Name':'end station name',
+                            'End Station Latitude':'end station latitude',
+                            'End Station Longitude':'end station longitude',
+                            'Bike ID':'bikeid',
+                            'User Type':'usertype',
+                            'Birth Year':'birth year',
+                            'Gender': 'gender'}))
+
+    # Cleans NaN data
+    df['usertype'].fillna('', inplace=True)
+    df['birth year'] = pd.to_numeric(df['birth year'], errors='coerce') # Forces \N values to NaN
+    df['birth year'].fillna(1800, inplace=True) # Changes NaN to 1800
+    miss_start = sum(df['start station id'].isna())
+    if miss_start > 0:
+        df.dropna(subset=['start station id'], inplace=True)
+    miss_end = sum(df['end station id'].isna())
+    if miss_end > 0:
+        df.dropna(subset=['end station id'], inplace=True)
+
+    # There are some dummy station information, where lat/long is 0
+    # These records were dropped
+    # The four checks are combined into one mask, so the df is only copied once
+    df = df[(df['start station longitude'] != 0) & (df['start station latitude'] != 0) &
+            (df['end station longitude'] != 0) & (df['end station latitude'] != 0)]
+    cleaned_row_count = df.shape[0]
+    bad_stations = original_row_count - cleaned_row_count
+    bad_records += bad_stations
+    if bad_stations > 0:
+        print(f'{bad_stations} rides were dropped due to bad station data.')
+
+    # Files of a known layout already have their timestamps parsed by the schema, the rest are fixed up as strings
+    if df['starttime'].dtype != object:
+        return df, bad_records
+
+    # Strips milliseconds from timestamp
+    if (df["starttime"].str.len() > 19).any():
+        df["starttime"] = df["starttime"].str.slice(stop=-5)
+    if (df["stoptime"].str.len() > 19).any():
+        df["stoptime"] = df["stoptime"].str.slice(stop=-5)
+
+
+    # Standardizes all date format to YYYY-MM-DD
+    if (df['starttime'].str.contains('/')).any():
+        reform_date = df['starttime'].str.split(' ').str[0]
+        df['starttime'] = pd.to_datetime(reform_date).dt.strftime('%Y-%m-%d') #+ ' ' + df['starttime'].str.split(' ').str[1] # the time is excluded, uncomment if needed
+        reform_date = df['stoptime'].str.split(' ').str[0]
+        df['stoptime'] = pd.to_datetime(reform_date).dt.strftime('%Y-%m-%d') #+ ' ' + df['stoptime'].str.split(' ').str[1] # the time is excluded, uncomment if needed
+
+    return df, bad_records
+
+# Function to build a stations df with the unique stations of the rides, the candidates for load_stations
+def station_candidates(df):
+    station_schema = ['station id', 'station name', 'station longitude', 'station latitude']
+    stations = pd.DataFrame(columns=station_schema)
+    start_station = df.iloc[:, 3:7].drop_duplicates()
+    start_station.columns = station_schema
+    end_station = df.iloc[:, 7:11].drop_duplicates()
+    end_station.columns = station_schema
+    frames = [stations, start_station, end_station]
+    stations = pd.concat(frames)
+    stations.drop_duplicates(subset = 'station id', inplace = True, keep = 'last', ignore_index = True)
+    return stations.dropna()
+
+# Function to add historical stations found in the rides to the DB TABLE station_dimension
+def load_stations(stations, filename):
+    # Historical/defunct stations are not available in the Citibike station JSON feed
+    # This bit of code will look at stations not in the DB TABLE station and insert the missing station information
+    # Current station information will be processed by etl_station_city.py
+    stations = stations[stations['station id'].isin(dim_cache.missing('stations', stations['station id']))]  # Filter out station id that already exists in the DB station
+
+    # Use Google Reverse Geocode API and insert into station_dimension if there are historical stations to add
+    if stations.shape[0] > 0:
+        if geocoder == 'offline':
+            # Look up every station at once in the local polygon files instead of calling the API per station
+            # The station_schema names follow the CSV column order, so 'station longitude' holds the latitude
+            with metrics.stage('geocode', filename, mode='offline') as event:
+                city_info = get_offline_geocoder().resolve(stations['station longitude'], stations['station latitude'])
+                event.update(rows=stations.shape[0], errors=(city_info['zipcode'] == '').sum())  # Stations outside of every zip code
+            stations = pd.concat([stations.reset_index(drop=True), city_info], axis=1)
+        else:
+            # Create a list of lat/long pair
+            coord = (stations['station longitude'].astype(str) + ',' + stations['station latitude'].astype(str)).tolist()
+            filter_results = 'postal_code|neighborhood|sublocality'
+            zipcodes = []
+
+            city_df = pd.DataFrame(columns=['zipcode', 'neighborhood', 'borough'])
+
+            # Send the reverse geocode requests for every lat/long pair at once through a pool of threads
+            # Stations geocoded by an earlier run or by etl_station_city.py are read from the local cache
+            with metrics.stage('geocode', filename, mode='google') as event, GeocodeCache.from_config(config) as geocode_cache:
+                geocodes = get_geocode_client().reverse_geocode_many(coord, filter_results, geocode_cache)
+                event.update(rows=len(coord), errors=sum(1 for geocode in geocodes if not geocode.get('results')))
+
+            # Loop goes through each lat/long pair's response from the Google Map reverse geocode API
+            # This will try to match a zip code to the lat/long pair
+            for row, pair in enumerate(coord):
+                geocode = geocodes[row]
+
+
+                # These are flag variables created to check if data is found in the Google API request
+                postalcode = False
+                neighborhood = False
+                borough = False
+                all_flag = False
+
+
+                # A temp dataframe is used to store the relevant information
+                # If the zip code is not in the city_df, then it will be appended with the temp_df
+                temp_df = pd.DataFrame(columns=['zipcode', 'neighborhood', 'borough'])
+                # The nested for loop is used to populate the zip code column in station_df, which will be used to populate the DB table station
+                # It is also used to create the city_df, which will be used to populate the DB table city
+                for data in geocode['results']:
+                    for add_comp in data['address_components']:
+                        if 'postal_code' in add_comp['types'] and not postalcode:
+                            postalcode = True
+                            zipcodes.append(add_comp['long_name'])
+                            temp_df.at[0,'zipcode'] = add_comp['long_name']
+                            if city_df['zipcode'].isin([add_comp['long_name']]).any():
                                 all_flag = True
-                                city_df = city_df.append(temp_df, ignore_index=True) 
                                 break
-                        if all_flag:
+                        elif 'neighborhood' in add_comp['types'] and not neighborhood:
+                            neighborhood = True
+                            temp_df.at[0,'neighborhood'] = add_comp['long_name']
+                        elif 'sublocality' in add_comp['types'] and not borough:
+                            borough = True
+                            temp_df.at[0, 'borough'] = add_comp['long_name']
+                        if postalcode and neighborhood and borough:
+                            all_flag = True
+                            city_df = city_df.append(temp_df, ignore_index=True) 
                             break
+                    if all_flag:
+                        break
+
+            city_df = city_df.fillna('')
+
+            # Add a new zip code column populating with data from the prior for loop
+            stations['zip code'] = zipcodes
+
+            # Perform a left join to merge the stations and the city df
+            stations = stations.merge(city_df, left_on='zip code', right_on='zipcode', how='left')
+
+        new_stations = stations[['station id', 'station name', 'station latitude', 'station longitude', 'zipcode', 'neighborhood', 'borough']]
+        new_stations = new_stations.dropna()
+        if stations.shape[0] > 0:
+            # Batch insert new station info into TABLE station_dimension
+            # Only stations that pass validation are cached, so rides at a rejected station are dropped before the fact insert
+            new_stations, bad_rows = loader.validate('historical stations', new_stations, filename)
+            new_stations = new_stations.to_records(index=False).tolist()  # Convert df to a list of tuples
+            loader.load('historical stations', new_stations, filename)
+            dim_cache.add('stations', [(station[0], station[6]) for station in new_stations])  # Keep the station id and borough
+
+# Function to fill Date_Dimension with every day of the calendar range once, instead of adding dates file by file
+def load_calendar():
+    days = calendar(pd.date_range(calendar_start, calendar_end, freq='D'))
+    days = days[days['date_id'].isin(dim_cache.missing('dates', days['date_id']))]
+    loader.load('dates', days.to_records(index=False).tolist(), 'calendar')
+    dim_cache.add('dates', [(date_id,) for date_id in days['date_id']])
+
+# Function to build the readable route path of each ride from the start and end station names
+def route_paths(df):
+    return df['start station name'].astype(object) + ' to ' + df['end station name'].astype(object)  # Station names may be categories
+
+# Function to add new dates, routes and users to their dimension tables
+# Returns the df with the route path, borough and user_id columns needed for the fact tables
+def load_dimensions(df, filename):
+    # The Date_ID of each ride is computed from the datetime64 values, without formatting them as strings
+    df['starttime'] = pd.to_datetime(df['starttime'])  # Only converts files of an unknown layout, the others are parsed when read
+    df['date_id'] = date_ids(df['starttime'])
+
+    # Dates in the calendar range are loaded up front by load_calendar, so this only adds rides outside of it
+    # Dimension keys are shared by every worker, so only one worker at a time looks up and inserts new keys
+    # The per-ride columns are computed outside of the lock, so the workers only wait on each other for the new keys
+    with dim_lock:
+        new_dates = dim_cache.missing('dates', pd.unique(df['date_id']))
+
+        if len(new_dates) > 0:
+            # Batch insert the new dates into the DB TABLE date_dimension
+            date_dim = calendar(df['starttime'].dt.normalize().unique())
+            date_dim = date_dim[date_dim['date_id'].isin(new_dates)]
+            date_dim_db = date_dim.to_records(index=False).tolist()  # Convert df to a list of tuples
+            loader.load('dates', date_dim_db, filename)
+            dim_cache.add('dates', [(date_id,) for date_id in new_dates])
+
+    # Concatenate the start and end station names to create the unique route
+    # With station route keys the route is identified by the station ids, and only new routes get a readable path
+    if route_keys == 'stations':
+        df['route_id'] = route_ids(df['start station id'], df['end station id'])
+    else:
+        df['route_path'] = route_paths(df)
+
+    # Get the borough information from the dimension cache
+    # Since borough information was obtained from the reverse geocode API, running it for each records would be expensive
+    # This information is stored in the DB, either from etl_station_city.py or the earlier code to get historical stations
+    # The boroughs are mapped from the station ids, which adds a column instead of copying the whole df like a merge
+    df['start_borough'] = df['start station id'].map(dim_cache.keys['stations'])
+    df['end_borough'] = df['end station id'].map(dim_cache.keys['stations'])
+    if route_keys != 'stations':
+        df['bor2bor'] = df['start_borough'] + ' to ' + df['end_borough']
+
+    # Missing data values can cause issues when running the batch upload into the DB
+    # Rather than trying to identifying and fixing these records, their count is miniscule compared to the overall count
+    # It was simplier to just drop these records
+    # Files from 2021-02 have no bike id, those rides are only dropped from BikeUsage_Fact
+    df = df.dropna(subset=df.columns.drop('bikeid'))
+
+
+    # Only add new routes identified in the raw data
+    # The route path is the primary key, so it is checked on its own
+    with dim_lock:
+        if route_keys == 'stations':
+            new_route_ids = dim_cache.missing('routes', pd.unique(df['route_id']))
+            route_df = df[df['route_id'].isin(new_route_ids)].drop_duplicates(subset='route_id')
+            route_df = pd.DataFrame({'route_id': route_df['route_id'],
+                                     'route_path': route_paths(route_df).str.slice(stop=120),  # Only an attribute, so a long path is cut instead of dropped
+                                     'bor2bor': route_df['start_borough'] + ' to ' + route_df['end_borough']})
+            new_routes, bad_rows = loader.validate('new route keys', route_df, filename)
+            new_routes = new_routes.to_records(index=False).tolist()  # Convert df to a list of tuples
+            loader.load('new route keys', new_routes, filename)
+            dim_cache.add('routes', [(route[0], route[2]) for route in new_routes])  # Keep the route id and borough to borough path
+        else:
+            route_df = df[['route_path', 'bor2bor']].drop_duplicates(subset='route_path')
+            new_route_paths = dim_cache.missing('routes', route_df['route_path'])
+            new_routes, bad_rows = loader.validate('new routes', route_df[route_df['route_path'].isin(new_route_paths)], filename)
+            new_routes = new_routes.to_records(index=False).tolist()  # Convert df to a list of tuples
+            loader.load('new routes', new_routes, filename)
+            dim_cache.add('routes', new_routes)
+
+    # Create a df user_dim to populate into the DB TABLE User_Dimension
+    user_dim = df[['usertype', 'birth year', 'gender']].drop_duplicates()
+    user_dim['age'] = datetime.now().year - user_dim['birth year']
+
+    if user_keys == 'natural':
+        # The user_id is computed from the natural key, so it is known before the insert and doesn't need to be read back
+        # Age is not part of the key, otherwise every new calendar year would add a duplicate of each user
+        df['user_id'] = natural_user_ids(df['usertype'], df['birth year'], df['gender'])
+        user_dim['user_id'] = natural_user_ids(user_dim['usertype'], user_dim['birth year'], user_dim['gender'])
+    else:
+        user_dim = user_dim[['usertype', 'birth year', 'age', 'gender']]
+        user_dim_list = user_dim.to_records(index=False).tolist()  # Convert df to a list of tuples
 
-                city_df = city_df.fillna('')
-
-                # Add a new zip code column populating with data from the prior for loop
-                stations['zip code'] = zipcodes
-
-                # Perform a left join to merge the stations and the city df
-                stations = stations.merge(city_df, left_on='zip code', right_on='zipcode', how='left')
-
-                new_stations = stations[['station id', 'station name', 'station latitude', 'station longitude', 'zipcode', 'neighborhood', 'borough']]
-                new_stations = new_stations.dropna()
-                if stations.shape[0] > 0:
-                    # Batch insert new station info into TABLE station_dimension
-                    new_stations = new_stations.to_records(index=False).tolist()  # Convert df to a list of tuples
-                    sql_insert_station(new_stations, 'historical stations', filename)
-                    # remove_bad_obj(new_stations, station_error, 'historical stations', file[0])
-            
-            # Create a table date_dim
-            df['starttime'] = pd.to_datetime(df['starttime']) # Convert to a datetime object to extract date values
-            df['day'] = df['starttime'].dt.day
-            df['week'] = df['starttime'].dt.isocalendar().week
-            df['month'] = df['starttime'].dt.month
-            df['year'] = df['starttime'].dt.year
-            df['weekday'] = df['starttime'].dt.day_name()
-            df['starttime'] = pd.to_datetime(df['starttime']).dt.strftime('%Y%m%d') # Convert datetime back to string
-
-            # Reorder the date dimension table to match the schema of the DB
-            date_dim = df[['starttime', 'day', 'week', 'month', 'year', 'weekday']].drop_duplicates()
-            date_db = [dates[0] for dates in cur.execute("SELECT date_id FROM admin.date_dimension")] # Convert a list of tuples to a list of ints
-
-            # Use a set comparision to identify new dates to be added
-            new_dates = list(set(date_dim['starttime'].astype(int).to_list()) - set(date_db))
-
-            if len(new_dates) > 0:
-                # Batch insert date_dim into the DB TABLE date_dimension
-                date_dim = date_dim[date_dim['starttime'].astype('int').isin(new_dates)]
-                date_dim_db = date_dim.to_records(index=False).tolist()  # Convert df to a list of tuples
-                sql_insert_date(date_dim_db, 'dates', filename)
-
-            # Concatenate the start and end station names to create the unique route
-            df['route_path'] = df['start station name'] + ' to ' + df['end station name']
-
-            # Run a SQL query to get the borough information from the DB
-            # Since borough information was obtained from the reverse geocode API, running it for each records would be expensive
-            # This information is stored in the DB, either from etl_station_city.py or the earlier code to get historical stations
-            updated_start_station = [stations for stations in cur.execute("SELECT station_id, borough FROM admin.station_dimension")]
-            updated_start_station = pd.DataFrame(updated_start_station, columns=['start station id', 'start_borough'])
-            updated_end_station = [stations for stations in cur.execute("SELECT station_id, borough FROM admin.station_dimension")]
-            updated_end_station = pd.DataFrame(updated_end_station, columns = ['end station id', 'end_borough'])
-            df = df.merge(updated_start_station, on='start station id', how='left')
-            df = df.merge(updated_end_station, on='end station id', how='left')
-            df['bor2bor'] = df['start_borough'] + ' to ' + df['end_borough']
-
-            # Missing data values can cause issues when running the batch upload into the DB
-            # Rather than trying to identifying and fixing these records, their count is miniscule compared to the overall count
-            # It was simplier to just drop these records
-            df = df.dropna()
-
-
-            # Get an updated list of route paths from the DB
-            # Do a set commparison to only add new routes identified in the raw data
-            route_dim = [routes for routes in cur.execute("SELECT routepath_id, route_path_bor FROM admin.route_dimension")]
-            route_df = df[['route_path', 'bor2bor']].drop_duplicates()
-            route_list = route_df.to_records(index=False).tolist()  # Convert df to a list of tuples
-            new_routes = list(set(route_list) - set(route_dim))
-            sql_insert_route(new_routes, 'new routes', filename)
-
-            # Create a df user_dim to populate into the DB TABLE User_Dimension
-            user_dim = df[['usertype', 'birth year', 'gender']].drop_duplicates()
-            user_dim['age'] = datetime.now().year - user_dim['birth year']
-            user_dim = user_dim[['usertype', 'birth year', 'age', 'gender']]
-            user_dim_list = user_dim.to_records(index=False).tolist()  # Convert df to a list of tuples
-            user_dim_db = [user for user in cur.execute("SELECT usertype, birth_year, age, gender FROM admin.user_dimension")]
-
+    with dim_lock:
+        if user_keys == 'natural':
             # Only add users that do not exist in the DB
-            new_users = list(set(user_dim_list) - set(user_dim_db))
+            new_users = user_dim[user_dim['user_id'].isin(dim_cache.missing('user_ids', user_dim['user_id']))]
+            new_users = new_users[['user_id', 'usertype', 'birth year', 'age', 'gender']]
+        else:
+            # Only add users that do not exist in the DB
+            new_users = dim_cache.missing('users', user_dim_list)
 
             # Convert the list of new users to a df
             # This step is needed to help convert gender id to gender name
             new_users = pd.DataFrame(new_users, columns = ['usertype', 'birth year', 'age', 'gender'])
-            conditions = [
-                (new_users['gender'] == 0),
-                (new_users['gender'] == 1),
-                (new_users['gender'] == 2)]
-            gender_name = ['Unknown', 'Male', 'Female']
-            new_users['gendername'] = np.select(conditions, gender_name)
-            new_users = new_users.to_records(index=False).tolist()  # Convert df to a list of tuples
-            sql_insert_user(new_users, 'users', filename)
-
-            # Since the DB is using an auto-generated ID as the primary key, we will need to query back the DB to get this value
-            updated_user_dim_db = cur.execute("SELECT user_id, usertype, birth_year, age, gender FROM admin.user_dimension")
-            updated_user_dim_db = [user for user in updated_user_dim_db]
-            updated_user_df = pd.DataFrame(updated_user_dim_db, columns = ['user_id', 'usertype', 'birthyear', 'age', 'gender'])
-            updated_user_df['gender'] = updated_user_df['gender'].astype(str).astype(int) # Need to convert column dtype from object to int
-
-            # Merge the updated user df with main df to insert the user_id 
-            df = df.merge(updated_user_df, left_on=['usertype', 'birth year', 'gender'], right_on=['usertype', 'birthyear', 'gender'], how='left')
-
-
-
-            # Batch insert the ride info into the TABLE BikeUsage_Fact
-            bikes = df[['bikeid', 'route_path', 'start station id', 'end station id', 'starttime', 'tripduration']]
-            bikes = bikes.dropna() # Drop records that do not have a route path
-            bikes['starttime'] = bikes['starttime'].astype(str).astype(int)
-            bikes = bikes.to_records(index=False).tolist()  # Convert df to a list of tuples
-            n = int(5e5)
-            if len(bikes) > n:
-                split_bikes = [bikes[i * n:(i + 1) * n] for i in range((len(bikes) + n - 1) // n)]  # Breaks up batch insert to size of n = 5e5
-                for bikes_chunk in split_bikes:
-                    bad_rows = sql_insert_bikes(bikes_chunk, 'new bikes', filename)
-                    bad_records += bad_rows
-                    # remove_bad_obj(rides_chunk, rides_error, 'new rides', file[0])
+
+        conditions = [
+            (new_users['gender'] == 0),
+            (new_users['gender'] == 1),
+            (new_users['gender'] == 2)]
+        gender_name = ['Unknown', 'Male', 'Female']
+        new_users['gendername'] = np.select(conditions, gender_name)
+        new_users = new_users.to_records(index=False).tolist()  # Convert df to a list of tuples
+        if len(new_users) > 0:
+            if user_keys == 'natural':  # The user_id is computed by natural_user_ids instead of the IDENTITY column
+                loader.load('users with ids', new_users, filename)
+                dim_cache.add('user_ids', [(user[0],) for user in new_users])
             else:
-                bad_rows = sql_insert_bikes(bikes, 'new bikes', filename)
+                loader.load('users', new_users, filename)
+
+                # Since the DB is using an auto-generated ID as the primary key, we will need to query back the DB to get this value
+                # This is only needed when new users were inserted, and only the new users are selected
+                dim_cache.fetch('users', [user[:4] for user in new_users])
+
+    if user_keys != 'natural':
+        updated_user_df = dim_cache.frame('users', ['usertype', 'birthyear', 'age', 'gender', 'user_id'])
+        updated_user_df['gender'] = updated_user_df['gender'].astype(str).astype(int) # Need to convert column dtype from object to int
+
+        # Merge the updated user df with main df to insert the user_id 
+        df = df.merge(updated_user_df, left_on=['usertype', 'birth year', 'gender'], right_on=['usertype', 'birthyear', 'gender'], how='left')
+
+    return df
+
+# Function to build the fact table rows from the rides, they are inserted by the load stage
+# Returns a list of (table name, rows, filename) batches and the number of records that failed validation
+def build_facts(df, filename):
+    bad_records = 0
+
+    # Ride info for the TABLE BikeUsage_Fact
+    bikes_table = 'new bikes with route keys' if route_keys == 'stations' else 'new bikes'
+    bikes = df[['bikeid', 'route_id' if route_keys == 'stations' else 'route_path', 'start station id', 'end station id', 'date_id', 'tripduration']]
+    bikes = bikes.dropna() # Drop records that do not have a route path
+    bikes, bad_rows = loader.validate(bikes_table, bikes, filename, {'routepath_id': dim_cache.keys['routes'],
+                                                                    'station_id_s': dim_cache.keys['stations'],
+                                                                    'station_id_e': dim_cache.keys['stations'],
+                                                                    'date_id': dim_cache.keys['dates']})
+    bad_records += bad_rows
+    bikes = bikes.to_records(index=False).tolist()  # Convert df to a list of tuples
+
+
+    # Ride info for the TABLE Ridership_Fact
+    ridership = df[['user_id', 'start station id', 'end station id', 'date_id', 'tripduration']]
+    ridership = ridership.dropna() # Drop records in case there is a NaN
+    ridership, bad_rows = loader.validate('new ridership', ridership, filename, {'user_id': dim_cache.keys['user_ids'],
+                                                                                'station_id_s': dim_cache.keys['stations'],
+                                                                                'station_id_e': dim_cache.keys['stations'],
+                                                                                'date_id': dim_cache.keys['dates']})
+    ridership = ridership.to_records(index=False).tolist()  # Convert df to a list of tuples
+
+    return [(bikes_table, bikes, filename), ('new ridership', ridership, filename)], bad_records
+
+# Load stage of the pipeline, run in its own thread with its own DB connection
+# Inserts the fact batches queued by the transform stage while the next chunk is being transformed
+# The fact rows of a chunk are only committed with the chunk's checkpoint, so a chunk is either fully loaded or not at all
+# Returns the number of records rejected by the DB, bad ridership records are logged but not counted twice
+def load_stage(batches):
+    connection = connect()
+    cur = connection.cursor()
+    fact_loader = new_loader(connection, cur)
+    bad_records = 0
+    chunk_bad_records = 0
+    try:
+        for name, rows, filename in batches:
+            if name == 'checkpoint':
+                zip_filename, csv_filename, row_offset, row_count, checkpoint_bad_records = rows
+                cur.execute("""INSERT INTO admin.data_checkpoint VALUES(:filename, :csv_filename, :row_offset, :row_count, :count)""",
+                            filename = zip_filename, csv_filename = csv_filename, row_offset = row_offset, row_count = row_count,
+                            count = checkpoint_bad_records + chunk_bad_records)
+                connection.commit()
+                chunk_bad_records = 0
+                continue
+
+            bad_rows = fact_loader.load(name, rows, filename, commit=False)  # The loader breaks up the batch insert by itself
+            if name != 'new ridership':
                 bad_records += bad_rows
-                # remove_bad_obj(rides, rides_error, 'new rides', file[0])
-            
-
-            # Batch insert the ride info into the TABLE Ridership_Fact
-            ridership = df[['user_id', 'start station id', 'end station id', 'starttime', 'tripduration']]
-            ridership = ridership.dropna() # Drop records in case there is a NaN
-            ridership['starttime'] = ridership['starttime'].astype(str).astype(int)
-            ridership = ridership.to_records(index=False).tolist()  # Convert df to a list of tuples
-            n = int(5e5)
-            if len(ridership) > n:
-                split_ridership = [ridership[i * n:(i + 1) * n] for i in range((len(ridership) + n - 1) // n)]  # Breaks up batch insert to size of n = 5e5
-                for ridership_chunk in split_ridership:
-                    bad_rows = sql_insert_ridership(ridership_chunk, 'new ridership', filename)
-                    # bad_records += bad_rows
-                    # remove_bad_obj(rides_chunk, rides_error, 'new rides', file[0])
-            else:
-                bad_rows = sql_insert_bikes(ridership, 'new ridership', filename)
-                # bad_records += bad_rows
-                # remove_bad_obj(rides, rides_error, 'new rides', file[0])
-
-    # Updated the TABLE data_processed
-    cur.execute("""INSERT INTO admin.data_processed VALUES(:filename, :count)""", filename = zip_filename, count = bad_records)
-    connection.commit()
-
+                chunk_bad_records += bad_rows
+        connection.commit()  # Batches queued without a checkpoint
+        print(fact_loader.report())
+    finally:
+        # Closing the connection rolls back a chunk that was not committed, so the transform stage isn't left waiting on its locks
+        cur.close()
+        connection.close()
+    return bad_records
+
+# Function to transform a DataFrame of cleaned rides, load its new dimension keys and build the fact rows
+# The whole CSV file can be passed in at once, or it can be called once per chunk of rows
+# Returns the fact batches for the load stage and the number of records that were dropped
+def process_rides(df, filename):
+    # Dimension keys are shared by every worker, so only one worker at a time looks up and inserts new keys
+    # Fact rows don't conflict with each other and are inserted by all workers at the same time
+    with stage('stations', filename) as event:
+        stations = station_candidates(df)
+        with dim_lock:
+            load_stations(stations, filename)
+        event['rows'] = df.shape[0]
+    with stage('dimensions', filename) as event:
+        df = load_dimensions(df, filename)
+        event['rows'] = df.shape[0]
+
+    with stage('facts', filename) as event:
+        facts, bad_records = build_facts(df, filename)
+        event.update(rows=df.shape[0], errors=bad_records)
+    return facts, bad_records
+
+
+# Zip code, neighborhood and borough can be resolved with the Google API or offline from local polygon files
+geocoder = config.get('geocoder', 'mode', fallback='google')  # google or offline
+geocode_client = None
+offline_geocoder = None
+
+# Function to create the Google API client the first time it is needed, each worker process gets its own session
+def get_geocode_client():
+    global geocode_client
+    if geocode_client is None:
+        geocode_client = GeocodeClient.from_config(config)
+    return geocode_client
+
+# Function to load the polygon files the first time they are needed, so runs with no new stations skip it
+def get_offline_geocoder():
+    global offline_geocoder
+    if offline_geocoder is None:
+        offline_geocoder = OfflineGeocoder.from_config(config)
+    return offline_geocoder
+
+# Citibike trip data bucket
+url = "https://s3.amazonaws.com/tripdata/"
 
-cur.close()
-connection.close()
 
-end_time = datetime.now()
-print(end_time - start_time)
+# Downloaded zip files are kept in spool_dir and revalidated with conditional GETs
+archive_store = ArchiveStore(spool_dir, keep=keep_zips)
+
+# Cleaned rides can be staged as Parquet files, so re-runs skip the download and the CSV parsing
+staging_dir = config.get('etl', 'staging_dir', fallback='')  # Empty turns the staging cache off
+staging = StagingCache(staging_dir) if staging_dir else None
+
+# Download stage of the pipeline, fetches a zip file either to a spool file on disk or entirely in memory
+# The S3 ETag is used as the content hash of the zip file, and nothing is downloaded if that version is already staged
+# The ETag from the bucket listing can be passed as content_hash, otherwise it is requested with a HEAD request
+# Returns the content hash and the spool path or zip content (None if staged), the zip members are extracted by the transform stage
+def fetch_zip(zip_filename, content_hash=None):
+    if staging is not None:
+        if content_hash is None:
+            content_hash = requests.head(url + zip_filename, timeout=60).headers.get('ETag', '').strip('"') or None
+        if content_hash is not None and (zip_filename, content_hash) in staging:
+            return content_hash, None
+
+    # Runs in the download thread, so it is recorded in the metrics but not in the memory budget of the transform stage
+    with metrics.stage('download', zip_filename) as event:
+        if download_mode == 'stream':
+            spool_path, meta = archive_store.fetch(url + zip_filename)
+            event['bytes'] = meta['size']
+            return content_hash, spool_path
+        content = requests.get(url + zip_filename).content
+        event['bytes'] = len(content)
+        return content_hash, content
+
+# Function to read every CSV file of a downloaded zip file and clean it
+# In chunked mode each file is read chunk_rows rows at a time, so memory stays flat regardless of the file size
+# resume maps a CSV file to the number of rows already loaded by an earlier run, those rows are skipped without being parsed
+# Yields (filename, row offset, df, bad records) for each chunk, the offset counting the rows of the file before the chunk
+def read_rides(fetched, resume=None):
+    resume = resume if resume is not None else {}
+    # Extracts the zip files, either from a memory-mapped spool file or from memory
+    if download_mode == 'stream':
+        extracted = extract_zip_spooled(fetched)
+    else:
+        extracted = extract_zip(fetched)
 
-print(f'Total records: {total_records}')
\ No newline at end of file
+    # Loop that goes through all files in the zip extract
+    for filename, fileobj in extracted:
+        if filename.endswith(".csv") and 'MACOSX' not in filename:  # Only process valid csv files
+            # The header line tells which generation of the trip data the file is from
+            # Known layouts are read with explicit types and only the columns needed, instead of letting pandas infer them
+            header, schema = detect_schema(fileobj.readline().decode('cp1252'))
+            offset = resume.get(filename, 0)
+            coerce = False
+            if schema is not None:
+                reader = schema.reader(fileobj, header, offset)
+            else:
+                reader = pd.read_csv(fileobj, encoding='cp1252', header=None, names=header, skiprows=offset, iterator=True)
+
+            # In chunked mode each chunk is chunk_rows rows, or sized to fit the memory budget
+            while True:
+                size = budget.chunk_rows() if budget is not None else chunk_rows or None
+                with stage('read', filename) as event:
+                    try:
+                        df = reader.get_chunk(size)
+                    except StopIteration:
+                        event['skipped'] = True  # The end of the file, not a chunk
+                        break
+                    except ValueError:
+                        # A dirty value the typed columns can't hold, the chunk and the rest of the file are read again
+                        # from the start of the chunk with the coerced columns as strings
+                        if schema is None or coerce:
+                            raise
+                        print(f'{filename} has dirty values after row {offset}, reading the rest of it with the coerced columns as strings')
+                        coerce = True
+                        fileobj.seek(0)
+                        fileobj.readline()
+                        reader = schema.reader(fileobj, header, offset, coerce=True)
+                        df = reader.get_chunk(size)
+                    rows = df.shape[0]
+                    if schema is not None:
+                        df = schema.normalize(df)
+                    event['rows'] = rows
+                with stage('clean', filename) as event:
+                    df, bad_records = clean_rides(df)
+                    event.update(rows=rows, errors=bad_records)
+                    if list(df.columns) != ride_columns:
+                        df = df[ride_columns]
+                    if budget is not None:
+                        df = downcast(df)
+                yield filename, offset, df, bad_records
+                offset += rows
+
+# Function to read the rides of a zip file and write them to the staging cache on the way
+def stage_rides(zip_filename, content_hash, rides):
+    writer = staging.writer(zip_filename, content_hash)
+    for filename, offset, df, bad_records in rides:
+        writer.add(filename, df, bad_records)
+        yield filename, offset, df, bad_records
+    writer.commit()
+
+# Function to download a zip file, load every CSV file inside it and mark it as processed
+# The zip file can be fetched ahead of time by the download stage, otherwise it is downloaded here
+# Each chunk is transformed here while the load stage inserts the facts of the previous chunks
+# Every chunk is committed with a checkpoint in TABLE data_checkpoint, so a run that stops part way resumes at the next chunk
+# Returns the number of rides read from the zip file
+def process_zip(zip_filename, fetched=None):
+    zip_start = time.perf_counter()
+    total_records = 0
+    bad_records = 0
+
+    # Rows of each CSV file loaded by an earlier run of this zip file, and the bad records it found
+    resume = {}
+    cur.execute("""SELECT csv_filename, MAX(row_offset + row_count), SUM(bad_records) FROM admin.data_checkpoint
+                   WHERE filename = :filename GROUP BY csv_filename""", filename = zip_filename)
+    for csv_filename, row_offset, checkpoint_bad_records in cur.fetchall():
+        resume[csv_filename] = row_offset
+        bad_records += checkpoint_bad_records
+    if resume:
+        print(f'\nResuming {zip_filename} after {sum(resume.values())} rows')
+
+    if fetched is None:
+        fetched = fetch_zip(zip_filename)
+    content_hash, fetched = fetched
+    if fetched is None:
+        print(f'\nReading {zip_filename} from the staging cache')
+        rides = staging.read(zip_filename, content_hash, ride_columns)
+    elif staging is not None and content_hash is not None and not resume:  # A resumed zip file skips rows, so it can't be staged
+        rides = stage_rides(zip_filename, content_hash, read_rides(fetched))
+    else:
+        rides = read_rides(fetched, resume)
+    fact_stage = Drain(load_stage, queue_batches)
+
+    current_file = None
+    for filename, offset, df, clean_bad_records in rides:
+        # The dimension cache holds the files in DB TABLE data_processed, to make sure duplicate files are not reprocessed
+        if ('processed', filename) in dim_cache or offset < resume.get(filename, 0):
+            continue
+        if filename != current_file:
+            print(f'\nProcessing {filename}')
+            current_file = filename
+
+        rows = df.shape[0] + clean_bad_records
+        total_records += rows
+        facts, fact_bad_records = process_rides(df, filename)
+        bad_records += clean_bad_records + fact_bad_records
+        for batch in facts:
+            fact_stage.put(batch)  # Blocks while the load stage is queue_batches behind
+        # The load stage commits the fact rows of the chunk together with its checkpoint
+        fact_stage.put(('checkpoint', (zip_filename, filename, offset, rows, clean_bad_records + fact_bad_records), filename))
+        if budget is not None:
+            budget.end_chunk(rows)
+    print(f'Dimension cache: {dim_cache.stats()}')
+    print(loader.report())
+    if budget is not None:
+        print(f'Memory by stage:\n{budget.report()}')
+
+    # Wait for the load stage to insert every fact row before the zip file is marked as processed
+    bad_records += fact_stage.close()
+
+    # Updated the TABLE data_processed, the checkpoints of the zip file are removed in the same transaction
+    cur.execute("""INSERT INTO admin.data_processed VALUES(:filename, :count)""", filename = zip_filename, count = bad_records)
+    cur.execute("""DELETE FROM admin.data_checkpoint WHERE filename = :filename""", filename = zip_filename)
+    connection.commit()
+    dim_cache.add('processed', [(zip_filename,)])
+
+    # The spool file is only kept around to resume interrupted downloads, unless keep_zips is set
+    archive_store.remove(url + zip_filename)
+
+    metrics.record('zip', zip_filename, {}, time.perf_counter() - zip_start, {'rows': total_records, 'bytes': 0, 'errors': bad_records}, 'ok')
+    return total_records
+
+# Function run by the worker processes, the metrics recorded by a worker are added to the main process's
+def process_zip_metrics(zip_filename):
+    zip_records = process_zip(zip_filename)
+    if metrics.profiler is not None:
+        metrics.profiler.finish()
+    return zip_records, metrics.take()
+
+
+if __name__ == '__main__':
+    # The main script is guarded so that worker processes importing this file don't rerun it
+    parser = argparse.ArgumentParser(description='Load the Citibike trip data into the warehouse')
+    parser.add_argument('--max-memory', type=parse_size,
+                        help='memory budget such as 4G, shared by the worker processes. Chunk and batch sizes are adapted to stay under it')
+    parser.add_argument('--profile', nargs='?', const='./profile', metavar='DIR',
+                        help='profile the time of each file and stage with cProfile, the results are written to DIR (./profile by default)')
+    parser.add_argument('--profile-memory', nargs='?', type=int, const=1, metavar='FRAMES',
+                        help='trace the memory of each file and stage with tracemalloc instead, keeping FRAMES frames of each allocation (1 by default)')
+    args = parser.parse_args()
+    max_memory = args.max_memory // workers if args.max_memory else None
+    budget = MemoryBudget(max_memory) if max_memory else None
+    profile_dir = args.profile or ('./profile' if args.profile_memory else None)
+    metrics.profiler = Profiler(profile_dir, args.profile_memory) if profile_dir else None
+
+    connection = connect()
+    cur = connection.cursor()
+
+    # Load the dimension keys once, they are kept up to date as new rows are inserted
+    dim_cache = DimensionCache(cur)
+    loader = new_loader(connection, cur)
+    load_calendar()
+
+    # Gets the zip files of the Citibike bucket, for this project the data was limited to NYC data from listing_start to listing_end
+    zip_entries = {entry.key: entry for entry in trip_zips(list_bucket(url), listing_start, listing_end)}
+    zip_files = list(zip_entries)
+
+    # Check if files to be downloaded has already been processed
+    processed = dim_cache.keys['processed']
+    new_zips = sorted(set(zip_files) - set(processed) - set(['201307-201402-citibike-tripdata.zip']), reverse = True) # 201307-201402-citibike-tripdata.zip has its contents extracted already, remove duplicate effort
+
+    print(f'Identified {len(new_zips)} new file(s).')
+
+    total_records = 0
+
+    # Loop to visit all new identified links on Citibike data website
+    # With more than one worker, the zip files are spread over a pool of processes with their own DB connections
+    # The largest zip files are handed out first, so the workers finish at about the same time
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=(multiprocessing.Lock(), max_memory, profile_dir, args.profile_memory)) as pool:
+            for zip_records, zip_metrics in pool.imap_unordered(process_zip_metrics, sorted(new_zips, key=lambda key: zip_entries[key].size, reverse=True)):
+                total_records += zip_records
+                metrics.merge(zip_metrics)
+                metrics.write_textfile()
+    else:
+        # The download stage fetches the next zip files while the current one is transformed and loaded
+        for zip_filename, fetched in prefetch(((zip_filename, fetch_zip(zip_filename, zip_entries[zip_filename].etag or None)) for zip_filename in new_zips), prefetch_zips):
+            total_records += process_zip(zip_filename, fetched)
+            metrics.write_textfile()  # Updated after each zip file, so the scheduler sees the progress of a long run
+
+    cur.close()
+    connection.close()
+    metrics.write_textfile(success=True)
+    if metrics.profiler is not None:
+        metrics.profiler.finish()
+        print(f'Profiles written to {metrics.profiler.path}')
+
+    end_time = datetime.now()
+    print(end_time - start_time)
+
+    print(f'Total records: {total_records}')
@@ -1,11 +1,17 @@
 #%%
+import argparse
+import hashlib
 import requests
 import json
+import os
 import pandas as pd
-import cx_Oracle
 import configparser
 from datetime import datetime
 from bs4 import BeautifulSoup
+from geocode import GeocodeCache, GeocodeClient, OfflineGeocoder
+from metrics import Metrics
+from profiling import Profiler
+from warehouse import get_warehouse
 
 # Function to write SQL batch errors to a log file
 def log_error(batch, process):
@@ -19,20 +25,42 @@ def log_error(batch, process):
         print(f'Log file written with {len(batch)} errors to ./log/{process}.txt')
 
 
-# Connect to Oracle Autonomous Data Warehouse using Wallet and local config file for user/pw storage
-cx_Oracle.init_oracle_client(lib_dir=".venv/instantclient_19_10")
+# Function to compute a hash of each station row, a station that hasn't changed always gets the same hash
+# The values are normalized first: NaN is never equal to itself, and the coordinates are rounded to 6 decimals (about 10cm)
+def row_hashes(df):
+    text = df['station_id'].astype('int64').astype(str)
+    for column in ['name', 'lat', 'lon', 'zipcode', 'neighborhood', 'borough']:
+        values = df[column].map('{:.6f}'.format) if column in ('lat', 'lon') else df[column].astype(object).where(df[column].notna(), '').astype(str)
+        text = text + '|' + values.str.strip()
+    return [hashlib.md5(row.encode()).hexdigest() for row in text]
+
+
+# Connect to Oracle Autonomous Data Warehouse, or the local SQLite warehouse, using the local config file for user/pw storage
 config = configparser.ConfigParser()
 config.read('./auth/config.ini')
-username = config.get('oracle', 'username')
-password = config.get('oracle', 'password')
-connection = cx_Oracle.connect(username, password, 'dwaproject_high')
+warehouse = get_warehouse(config)
+connection = warehouse.connect()
 cur = connection.cursor()
 
+# Durations, row counts and errors of every stage are recorded as JSON events, and optionally exported for Prometheus
+metrics = Metrics.from_config(config, 'stations')
+
+parser = argparse.ArgumentParser(description='Load the Citibike stations into the warehouse')
+parser.add_argument('--profile', nargs='?', const='./profile', metavar='DIR',
+                    help='profile the time of each stage with cProfile, the results are written to DIR (./profile by default)')
+parser.add_argument('--profile-memory', nargs='?', type=int, const=1, metavar='FRAMES',
+                    help='trace the memory of each stage with tracemalloc instead, keeping FRAMES frames of each allocation (1 by default)')
+args = parser.parse_args()
+profile_dir = args.profile or ('./profile' if args.profile_memory else None)
+metrics.profiler = Profiler(profile_dir, args.profile_memory) if profile_dir else None
+
 
-# Get Citibike station information
-cb_url = 'https://gbfs.citibikenyc.com/gbfs/en/station_information.json'
-cb_r = requests.get(cb_url)
-cb_raw_data = json.loads(cb_r.text)['data']['stations']
+# Get Citibike station information, the feed can be pointed to a local copy in config.ini
+cb_url = config.get('gbfs', 'station_information', fallback='https://gbfs.citibikenyc.com/gbfs/en/station_information.json')
+with metrics.stage('download', cb_url) as event:
+    cb_r = requests.get(cb_url)
+    cb_raw_data = json.loads(cb_r.text)['data']['stations']
+    event.update(rows=len(cb_raw_data), bytes=len(cb_r.content))
 
 # Convert Citibike JSON data into dataframe
 station_dict = {index: station for index, station in enumerate(cb_raw_data)}
@@ -43,130 +71,127 @@ station_df = station_df[['station_id', 'name', 'lat', 'lon']]
 station_df['station_id'] = pd.to_numeric(station_df['station_id'], errors='coerce')
 
 
-# Load Google Map API key
-gg_api = config.get('google', 'api')
-gg_url = 'https://maps.googleapis.com/maps/api/geocode/json'
-
-
-# Create a list of lat/long pair
-coord = (station_df['lat'].astype(str) + ',' + station_df['lon'].astype(str)).tolist()
-zipcodes = []
-
-# This variable is used to fitler the API result from Google for zip code, neighborhood, borough, city, county, and state, respectively
-filter_results = 'postal_code|neighborhood|sublocality|locality|administrative_area_level_2, administrative_area_level_1'
-
-city_df = pd.DataFrame(columns=['zipcode', 'neighborhood', 'borough', 'city', 'county', 'state'])
-
-# Loop goes through each lat/long pair to find the zip code, and its respective location information
-for row, pair in enumerate(coord):
-    # Google Map reverse geocode API URL
-    gg_r = requests.get(f'{gg_url}?latlng={pair}&key={gg_api}&results={filter_results}')
-    geocode = json.loads(gg_r.text)
-
-
-    # These are flag variables created to check if data is found in the Google API request
-    postalcode = False
-    neighborhood = False
-    borough = False
-    city = False
-    county = False
-    state = False
-    all_flag = False
-
-
-    # A temp dataframe is used to store the relevant information
-    # If the zip code is not in the city_df, then it will be appended with the temp_df
-    temp_df = pd.DataFrame(columns=['zipcode', 'neighborhood', 'borough', 'city', 'county', 'state'])
-    # The nested for loop is used to populate the zip code column in station_df, which will be used to populate the DB table station
-    # It is also used to create the city_df, which will be used to populate the DB table city
-    for data in geocode['results']:
-        for add_comp in data['address_components']:
-            if 'postal_code' in add_comp['types'] and not postalcode:
-                postalcode = True
-                zipcodes.append(add_comp['long_name'])
-                temp_df.at[0,'zipcode'] = add_comp['long_name']
-                if city_df['zipcode'].isin([add_comp['long_name']]).any():
-                    all_flag = True
-                    break
-            elif 'neighborhood' in add_comp['types'] and not neighborhood:
-                neighborhood = True
-                temp_df.at[0,'neighborhood'] = add_comp['long_name']
-            elif 'sublocality' in add_comp['types'] and not borough:
-                borough = True
-                temp_df.at[0, 'borough'] = add_comp['long_name']
-            elif 'locality' in add_comp['types'] and not city:
-                city = True
-                temp_df.at[0,'city'] = add_comp['long_name']
-            elif 'administrative_area_level_2' in add_comp['types'] and not county:
-                county = True
-                temp_df.at[0,'county'] = add_comp['long_name']
-            elif 'administrative_area_level_1' in add_comp['types'] and not state:
-                state = True
-                if add_comp['long_name'] == 'New Jersey': # Borough is only for NY as NJ doesn't have any boroughs, so the variable is set True if NJ
-                    borough = True 
-                temp_df.at[0,'state'] = add_comp['long_name']
-            if postalcode and neighborhood and borough and city and county and state:
-                all_flag = True
-                city_df = city_df.append(temp_df, ignore_index=True) 
-                break
-        if all_flag:
-            break
-city_df.fillna('', inplace=True)
-city_df = city_df[['zipcode', 'neighborhood', 'borough']]
-
-# Add the zip codes to the station_df
-station_df['zipcode'] = zipcodes
-
-# Perform a left join to merge the station df and the city df
-full_station_df = station_df.merge(city_df, on='zipcode', how='left')
-
-
-# Check for new station id not in table station
-new_station_id = full_station_df['station_id'].tolist()
-station_db = [station for station in cur.execute("select * from admin.station_dimension")]  # Creates a list of tuples from SQL query
-if len(station_db) == 0:
-    exist_station_id = []
+# Zip code, neighborhood and borough can be resolved with the Google API or offline from local polygon files
+geocoder = config.get('geocoder', 'mode', fallback='google')  # google or offline
+if geocoder == 'offline':
+    # Look up every station at once instead of sending one API request per station
+    with metrics.stage('geocode', mode='offline') as event:
+        city_info = OfflineGeocoder.from_config(config).resolve(station_df['lat'], station_df['lon'])
+        event.update(rows=station_df.shape[0], errors=(city_info['zipcode'] == '').sum())  # Stations outside of every zip code
+    full_station_df = pd.concat([station_df.reset_index(drop=True), city_info], axis=1)
 else:
-    # Extract the station id from the list of tuples
-    exist_station_id = [station[0] for station in station_db]
-ids_to_add = list(set(new_station_id) - set(exist_station_id))
-new_stations = full_station_df[full_station_df['station_id'].isin(ids_to_add)]
-
-
-
-# Batch insert new station info into table station_dimension
-if new_stations.shape[0] > 0: # only run insert SQL code if there are new stations to insert
-    stations = new_stations.to_records(index=False).tolist() # Convert df to a list of tuples
-    cur.executemany("""
-        INSERT INTO admin.station_dimension
-        VALUES(:1, :2, :3, :4, :5, :6, :7)""", stations, batcherrors=True)
-    log_error(cur.getbatcherrors(), 'new station')
-    connection.commit()
-    print(f'{len(stations) - len(cur.getbatcherrors())} stations has been inserted.')
-
-# Find existing stations that require update
-check_id = list(set(new_station_id) & set(exist_station_id))
-check_stations_df = full_station_df[full_station_df['station_id'].isin(check_id)]
-check_stations_df = check_stations_df.to_records(index=False).tolist()  # Convert df to a list of tuples
-stations_to_update = list(set(check_stations_df) - set(station_db))
-
-if len(stations_to_update) > 0:  # only run update SQL code if there are stations to update
-    # Need to convert to list of list to utilize the .pop method
-    stations_to_update = [list(tup) for tup in stations_to_update]  
-
-    # Move the station_id to the end of the list
-    # This is due to bind variables being positional relative to the parameter
-    # Since the SQL WHERE clause is at the end, we need to shift station_id to the end of the list
-    [lst.append(lst.pop(0)) for lst in stations_to_update]
-
-    # Batch update new station info into table station_dimension
-    cur.executemany("""
-        UPDATE admin.station_dimension 
-        SET station_name = :1, station_latitude = :2, station_longitude = :3, zipcode = :4, neighborhood = :5, borough = :6
-        WHERE station_id = :7 """, stations_to_update, batcherrors=True)
-    log_error(cur.getbatcherrors(), 'update station')
-    connection.commit()
-    print(f'{len(stations_to_update) - len(cur.getbatcherrors())} stations has been updated.')
+    # Create a list of lat/long pair
+    coord = (station_df['lat'].astype(str) + ',' + station_df['lon'].astype(str)).tolist()
+    zipcodes = []
+
+    # This variable is used to fitler the API result from Google for zip code, neighborhood, borough, city, county, and state, respectively
+    filter_results = 'postal_code|neighborhood|sublocality|locality|administrative_area_level_2, administrative_area_level_1'
+
+    city_df = pd.DataFrame(columns=['zipcode', 'neighborhood', 'borough', 'city', 'county', 'state'])
+
+    # Send the reverse geocode requests for every lat/long pair at once through a pool of threads
+    # Stations that haven't moved since the last run are answered from the local cache without calling the API
+    with metrics.stage('geocode', mode='google') as event, GeocodeCache.from_config(config) as geocode_cache:
+        geocodes = GeocodeClient.from_config(config).reverse_geocode_many(coord, filter_results, geocode_cache)
+        event.update(rows=len(coord), errors=sum(1 for geocode in geocodes if not geocode.get('results')))
+
+    # Loop goes through each lat/long pair's response to find the zip code, and its respective location information
+    with metrics.stage('parse geocodes') as event:
+        for row, pair in enumerate(coord):
+            geocode = geocodes[row]
+
+
+            # These are flag variables created to check if data is found in the Google API request
+            postalcode = False
+            neighborhood = False
+            borough = False
+            city = False
+            county = False
+            state = False
+            all_flag = False
+
+
+            # A temp dataframe is used to store the relevant information
+            # If the zip code is not in the city_df, then it will be appended with the temp_df
+            temp_df = pd.DataFrame(columns=['zipcode', 'neighborhood', 'borough', 'city', 'county', 'state'])
+            # The nested for loop is used to populate the zip code column in station_df, which will be used to populate the DB table station
+            # It is also used to create the city_df, which will be used to populate the DB table city
+            for data in geocode['results']:
+                for add_comp in data['address_components']:
+                    if 'postal_code' in add_comp['types'] and not postalcode:
+                        postalcode = True
+                        zipcodes.append(add_comp['long_name'])
+                        temp_df.at[0,'zipcode'] = add_comp['long_name']
+                        if city_df['zipcode'].isin([add_comp['long_name']]).any():
+                            all_flag = True
+                            break
+                    elif 'neighborhood' in add_comp['types'] and not neighborhood:
+                        neighborhood = True
+                        temp_df.at[0,'neighborhood'] = add_comp['long_name']
+                    elif 'sublocality' in add_comp['types'] and not borough:
+                        borough = True
+                        temp_df.at[0, 'borough'] = add_comp['long_name']
+                    elif 'locality' in add_comp['types'] and not city:
+                        city = True
+                        temp_df.at[0,'city'] = add_comp['long_name']
+                    elif 'administrative_area_level_2' in add_comp['types'] and not county:
+                        county = True
+                        temp_df.at[0,'county'] = add_comp['long_name']
+                    elif 'administrative_area_level_1' in add_comp['types'] and not state:
+                        state = True
+                        if add_comp['long_name'] == 'New Jersey': # Borough is only for NY as NJ doesn't have any boroughs, so the variable is set True if NJ
+                            borough = True 
+                        temp_df.at[0,'state'] = add_comp['long_name']
+                    if postalcode and neighborhood and borough and city and county and state:
+                        all_flag = True
+                        city_df = city_df.append(temp_df, ignore_index=True) 
+                        break
+                if all_flag:
+                    break
+        event['rows'] = len(coord)
+    city_df.fillna('', inplace=True)
+    city_df = city_df[['zipcode', 'neighborhood', 'borough']]
+
+    # Add the zip codes to the station_df
+    station_df['zipcode'] = zipcodes
+
+    # Perform a left join to merge the station df and the city df
+    full_station_df = station_df.merge(city_df, on='zipcode', how='left')
+
+
+# Stage the snapshot of the feed in one batch insert, and merge it into table station_dimension in a single statement
+# Only new stations and stations whose row hash changed are written, unchanged stations aren't sent back to the warehouse
+station_columns = ['station_id', 'station_name', 'station_latitude', 'station_longitude', 'zipcode', 'neighborhood', 'borough']
+with metrics.stage('stage', table='admin.station_staging') as event:
+    full_station_df = full_station_df.dropna(subset=['station_id']).astype({'station_id': 'int64'})  # Station ids that aren't numbers can't be keyed
+    full_station_df = full_station_df[['station_id', 'name', 'lat', 'lon', 'zipcode', 'neighborhood', 'borough']]
+    full_station_df = full_station_df.assign(row_hash=row_hashes(full_station_df))
+    stations = full_station_df.astype(object).where(full_station_df.notna(), None).to_records(index=False).tolist()  # NaN is bound as NULL
+    cur.execute("DELETE FROM admin.station_staging")  # Already empty on Oracle, the temporary table is emptied by each commit
+    cur.setinputsizes(*warehouse.input_sizes(['number', 70, 'number', 'number', 12, 50, 50, 32]))
+    cur.executemany(f"""
+        INSERT INTO admin.station_staging ({', '.join(station_columns)}, row_hash)
+        VALUES(:1, :2, :3, :4, :5, :6, :7, :8)""", stations, batcherrors=True)
+    event.update(rows=len(stations), errors=len(cur.getbatcherrors()) + len(station_df) - len(stations))
+log_error(cur.getbatcherrors(), 'station staging')
+
+with metrics.stage('merge', table='admin.station_dimension') as event:
+    new_count, changed_count = cur.execute("""
+        SELECT COALESCE(SUM(CASE WHEN d.station_id IS NULL THEN 1 ELSE 0 END), 0),
+               COALESCE(SUM(CASE WHEN d.station_id IS NOT NULL AND (d.row_hash IS NULL OR d.row_hash <> s.row_hash) THEN 1 ELSE 0 END), 0)
+        FROM admin.station_staging s LEFT JOIN admin.station_dimension d ON d.station_id = s.station_id""").fetchone()
+    if new_count + changed_count > 0:  # only run the merge if there are stations to insert or update
+        cur.execute(warehouse.merge_sql('admin.station_dimension', 'admin.station_staging', 'station_id', station_columns))
+    event['rows'] = new_count + changed_count
+connection.commit()
+if new_count > 0:
+    print(f'{new_count} stations has been inserted.')
+if changed_count > 0:
+    print(f'{changed_count} stations has been updated.')
 
 cur.close()
 connection.close()
+metrics.write_textfile(success=True)
+if metrics.profiler is not None:
+    metrics.profiler.finish()
+    print(f'Profiles written to {metrics.profiler.path}')
@@ -0,0 +1,152 @@
+#%%
+import argparse
+import configparser
+import requests
+import time
+
+from array import array
+from loader import BulkLoader
+from metrics import Metrics
+from retrying import retry
+from warehouse import get_warehouse
+
+
+# Polls the GBFS station_status feed and loads the changes of each station into TABLE station_status_fact
+# Only the stations whose bikes, docks or renting status changed since the previous poll are kept,
+# so the rows written follow the activity at the stations and not how often the feed is polled
+# Run python etl_station_status.py, it polls until stopped with Ctrl+C, or --polls times
+
+
+# Changes waiting to be inserted, kept as one typed array per column instead of a list of tuples
+# A change takes 29 bytes this way, instead of a tuple and six int objects
+class StatusBatch:
+    def __init__(self):
+        self.station_id = array('q')
+        self.polled = array('q')
+        self.reported = array('q')
+        self.bikes = array('l')
+        self.docks = array('l')
+        self.renting = array('b')
+
+    def __len__(self):
+        return len(self.station_id)
+
+    def append(self, station_id, polled, reported, state):
+        self.station_id.append(station_id)
+        self.polled.append(polled)
+        self.reported.append(reported)
+        self.bikes.append(state[0])
+        self.docks.append(state[1])
+        self.renting.append(state[2])
+
+    # Returns the rows in the column order of the 'station status' table of the loader
+    def rows(self):
+        return list(zip(self.station_id, self.polled, self.reported, self.bikes, self.docks, self.renting))
+
+
+# Function to download the station_status feed, wrapped in a function to use the retry function
+@retry(wait_fixed=5000, stop_max_attempt_number=3)
+def fetch_status(session, url):
+    response = session.get(url, timeout=30)
+    response.raise_for_status()
+    return response
+
+
+# Function to find the stations that changed since the previous poll, previous maps a station id to its last (bikes, docks, renting)
+# previous is updated in place, returns the number of stations skipped
+# Station ids that aren't numbers can't be keyed like in etl_station_city.py, and a station missing a field or with a bad value is skipped
+# instead of stopping the poller, it is read again at the next poll
+def add_changes(feed, previous, batch):
+    bad_stations = 0
+    polled = feed['last_updated']
+    for station in feed['data']['stations']:
+        try:
+            station_id = int(station['station_id'])
+            state = (int(station['num_bikes_available']), int(station['num_docks_available']), int(bool(station['is_renting'])))
+            reported = int(station.get('last_reported') or polled)
+        except (KeyError, TypeError, ValueError):
+            bad_stations += 1
+            continue
+        if previous.get(station_id) != state:
+            previous[station_id] = state
+            batch.append(station_id, polled, reported, state)
+    return bad_stations
+
+
+# Function to read the last status of every station from the warehouse, so a restart only adds the changes since the last run
+def last_status(cur):
+    return {station_id: (bikes, docks, renting) for station_id, bikes, docks, renting in cur.execute("""
+        SELECT s.station_id, s.bikes_available, s.docks_available, s.is_renting
+        FROM admin.station_status_fact s
+        JOIN (SELECT station_id, MAX(polled) AS polled FROM admin.station_status_fact GROUP BY station_id) m
+        ON s.station_id = m.station_id AND s.polled = m.polled""")}
+
+
+def flush(loader, batch, url):
+    if len(batch) > 0:
+        loader.load('station status', batch.rows(), url)
+    metrics.write_textfile()
+    return StatusBatch()
+
+
+# Connect to Oracle Autonomous Data Warehouse, or the local SQLite warehouse, using the local config file for user/pw storage
+config = configparser.ConfigParser()
+config.read('./auth/config.ini')
+
+# The feed can be pointed to a local stand-in in config.ini, e.g. the one written by synthetic.py --status-interval
+status_url = config.get('gbfs', 'station_status', fallback='https://gbfs.citibikenyc.com/gbfs/en/station_status.json')
+interval = config.getfloat('gbfs', 'status_interval', fallback=60)  # Seconds between polls
+flush_rows = config.getint('gbfs', 'status_flush_rows', fallback=50000)  # Changes held in memory before they are inserted
+flush_seconds = config.getfloat('gbfs', 'status_flush_seconds', fallback=600)  # Longest time a change waits to be inserted
+
+parser = argparse.ArgumentParser(description='Poll the Citibike station status feed and load the changes into the warehouse')
+parser.add_argument('--interval', type=float, default=interval, help='seconds between polls')
+parser.add_argument('--polls', type=int, default=0, help='number of polls before the changes are inserted and the script stops, 0 polls until stopped')
+args = parser.parse_args()
+
+warehouse = get_warehouse(config)
+connection = warehouse.connect()
+cur = connection.cursor()
+metrics = Metrics.from_config(config, 'status')
+loader = BulkLoader(warehouse, connection, cur, config.getfloat('etl', 'batch_seconds', fallback=5), metrics=metrics)
+
+session = requests.Session()
+previous = last_status(cur)
+batch = StatusBatch()
+last_updated = None
+last_flush = time.monotonic()
+polls = 0
+try:
+    while args.polls == 0 or polls < args.polls:
+        poll_start = time.monotonic()
+        polls += 1
+        try:
+            with metrics.stage('download', status_url) as event:
+                response = fetch_status(session, status_url)
+                feed = response.json()
+                feed['last_updated'] = int(feed['last_updated'])  # A feed without its time can't be told apart from the previous one
+                event.update(rows=len(feed['data']['stations']), bytes=len(response.content))
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            print(f'Poll of {status_url} failed, {e}')  # The next poll tries again, a failed poll only delays the changes
+            feed = None
+
+        # The feed is only regenerated every ttl seconds, a poll of the same feed has nothing new
+        if feed is not None and feed['last_updated'] != last_updated:
+            last_updated = feed['last_updated']
+            with metrics.stage('delta', status_url) as event:
+                changes = len(batch)
+                event['errors'] = add_changes(feed, previous, batch)
+                event['rows'] = len(batch) - changes
+
+        if len(batch) >= flush_rows or time.monotonic() - last_flush >= flush_seconds:
+            batch = flush(loader, batch, status_url)
+            last_flush = time.monotonic()
+        if args.polls == 0 or polls < args.polls:
+            time.sleep(max(0, poll_start + args.interval - time.monotonic()))
+except KeyboardInterrupt:
+    print('Stopped, inserting the changes polled so far')
+finally:
+    flush(loader, batch, status_url)
+    cur.close()
+    connection.close()
+metrics.write_textfile(success=True)
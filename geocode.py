@@ -0,0 +1,229 @@
+import json
+import numpy as np
+import os
+import pandas as pd
+import sqlite3
+import threading
+import time
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+
+gg_url = 'https://maps.googleapis.com/maps/api/geocode/json'
+
+
+# Function to normalize a 'lat,long' string so the same point is always stored under the same key
+# Coordinates are rounded to 6 decimal places (about 10cm), which is more precise than the station feed
+def normalize_pair(pair):
+    lat, lng = (round(float(value), 6) for value in pair.split(','))
+    return f'{lat:.6f},{lng:.6f}'
+
+
+# Persistent cache of Google reverse geocode responses, stored in a local SQLite file
+# The whole JSON response is cached, so etl_station_city.py and etl_rides.py can share entries
+# and each pick out the address components they need
+# Entries older than ttl_days are treated as missing and the oldest entries are evicted past max_entries
+class GeocodeCache:
+    def __init__(self, path='./cache/geocode.sqlite', ttl_days=180, max_entries=100000):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.ttl = ttl_days * 86400
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path, timeout=30)  # The timeout lets parallel workers wait on each other's writes
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS geocode (
+                pair        TEXT PRIMARY KEY,
+                response    TEXT,
+                fetched_at  REAL)""")
+        self.evict()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('google', 'cache_path', fallback='./cache/geocode.sqlite'),
+                   config.getint('google', 'cache_ttl_days', fallback=180),
+                   config.getint('google', 'cache_max_entries', fallback=100000))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Returns the cached response as a dict, or None if the pair is missing or expired
+    def get(self, pair):
+        row = self.conn.execute("SELECT response, fetched_at FROM geocode WHERE pair = ?", (normalize_pair(pair),)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def put(self, pair, geocode):
+        self.conn.execute("INSERT OR REPLACE INTO geocode VALUES(?, ?, ?)", (normalize_pair(pair), json.dumps(geocode), time.time()))
+        self.conn.commit()
+
+    # Deletes expired entries, then the oldest entries over max_entries
+    def evict(self):
+        self.conn.execute("DELETE FROM geocode WHERE fetched_at < ?", (time.time() - self.ttl,))
+        self.conn.execute("""
+            DELETE FROM geocode WHERE pair IN (
+                SELECT pair FROM geocode ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)""", (self.max_entries,))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+# Spaces out calls across threads so no more than per_second requests are started each second
+class RateLimiter:
+    def __init__(self, per_second):
+        self.interval = 1 / per_second if per_second > 0 else 0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+# Client for the Google Map reverse geocode API that sends requests from a pool of threads
+# All threads share one keep-alive session, so connections are reused instead of opened per request
+# 429 and 5xx responses, OVER_QUERY_LIMIT results and connection errors are retried with exponential backoff
+class GeocodeClient:
+    def __init__(self, api_key, requests_per_second=40, max_workers=8, max_retries=5, backoff=1):
+        self.api_key = api_key
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.limiter = RateLimiter(requests_per_second)
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_workers))
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('google', 'api'),
+                   config.getfloat('google', 'requests_per_second', fallback=40),
+                   config.getint('google', 'max_workers', fallback=8),
+                   config.getint('google', 'max_retries', fallback=5))
+
+    # Function to send one reverse geocode request, retrying until max_retries is reached
+    def reverse_geocode(self, pair, filter_results):
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            self.limiter.wait()
+            try:
+                gg_r = self.session.get(gg_url, params={'latlng': pair, 'key': self.api_key, 'results': filter_results}, timeout=30)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if last_attempt:
+                    raise
+            else:
+                if gg_r.status_code != 429 and gg_r.status_code < 500:
+                    geocode = gg_r.json()
+                    if geocode.get('status') != 'OVER_QUERY_LIMIT' or last_attempt:
+                        return geocode
+                elif last_attempt:
+                    gg_r.raise_for_status()
+            time.sleep(self.backoff * 2 ** attempt)
+
+    # Function to reverse geocode a list of 'lat,long' pairs, returning the responses in the same order
+    # Pairs found in the cache are not requested, the cache is only read and written from the calling thread
+    # since a SQLite connection can't be shared between threads
+    # Only successful responses are cached, so quota or key errors are retried on the next run
+    def reverse_geocode_many(self, coord, filter_results, cache=None):
+        geocodes = {}
+        for pair in coord:
+            if pair not in geocodes and cache is not None:
+                geocodes[pair] = cache.get(pair)
+        missing = [pair for pair in dict.fromkeys(coord) if geocodes.get(pair) is None]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            fetched = executor.map(lambda pair: self.reverse_geocode(pair, filter_results), missing)
+            for pair, geocode in zip(missing, fetched):
+                geocodes[pair] = geocode
+                if cache is not None and geocode.get('status') in ('OK', 'ZERO_RESULTS'):
+                    cache.put(pair, geocode)
+        return [geocodes[pair] for pair in coord]
+
+
+# Function to check which points fall inside a polygon, vectorized over points and edges with numpy
+# edges is an array of (x1, y1, x2, y2) rows covering every ring of the polygon, including holes
+# Uses the even-odd rule: a ray cast from a point that crosses an odd number of edges is inside
+def points_in_polygon(x, y, edges):
+    x1, y1, x2, y2 = (edges[:, i] for i in range(4))
+    x = x[:, None]
+    y = y[:, None]
+    crosses = (y1 > y) != (y2 > y)
+    with np.errstate(divide='ignore', invalid='ignore'):  # Horizontal edges never cross, their division result is unused
+        x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+    return ((crosses & (x < x_cross)).sum(axis=1) % 2) == 1
+
+
+# Polygons from one GeoJSON layer, with a grid index to find the candidate polygons for a point
+# Each grid cell lists the polygons whose bounding box overlaps it, so a point is only tested against a few polygons
+class PolygonLayer:
+    def __init__(self, path, name_property, cell_size=0.01):
+        with open(path) as f:
+            features = json.load(f)['features']
+
+        self.names = []
+        self.edges = []
+        self.bboxes = []
+        for feature in features:
+            geometry = feature['geometry']
+            if geometry is None:
+                continue
+            polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+            rings = [np.asarray(ring, dtype=float)[:, :2] for polygon in polygons for ring in polygon]
+            edges = np.vstack([np.hstack([ring[:-1], ring[1:]]) for ring in rings])  # GeoJSON rings are closed, last point == first point
+            self.names.append(str(feature['properties'][name_property]))
+            self.edges.append(edges)
+            self.bboxes.append((edges[:, [0, 2]].min(), edges[:, [1, 3]].min(), edges[:, [0, 2]].max(), edges[:, [1, 3]].max()))
+
+        self.cell_size = cell_size
+        self.grid = {}
+        for index, (min_x, min_y, max_x, max_y) in enumerate(self.bboxes):
+            for cx in range(int(np.floor(min_x / cell_size)), int(np.floor(max_x / cell_size)) + 1):
+                for cy in range(int(np.floor(min_y / cell_size)), int(np.floor(max_y / cell_size)) + 1):
+                    self.grid.setdefault((cx, cy), []).append(index)
+
+    # Returns an array with the name of the polygon containing each point, or '' if the point is in none of them
+    def lookup(self, lat, lng):
+        lat = np.asarray(lat, dtype=float)
+        lng = np.asarray(lng, dtype=float)
+        result = np.full(len(lat), '', dtype=object)
+        found = np.zeros(len(lat), dtype=bool)
+
+        cells = np.column_stack([np.floor(lng / self.cell_size), np.floor(lat / self.cell_size)]).astype(int)
+        unique_cells, cell_of_point = np.unique(cells, axis=0, return_inverse=True)
+        cell_of_point = cell_of_point.reshape(-1)
+        for cell_number, cell in enumerate(unique_cells):
+            in_cell = np.flatnonzero(cell_of_point == cell_number)
+            for index in self.grid.get(tuple(cell), []):
+                todo = in_cell[~found[in_cell]]
+                if len(todo) == 0:
+                    break
+                inside = points_in_polygon(lng[todo], lat[todo], self.edges[index])
+                result[todo[inside]] = self.names[index]
+                found[todo[inside]] = True
+        return result
+
+
+# Offline replacement for the Google reverse geocode API
+# Resolves zip code, neighborhood and borough from local polygon files (e.g. NYC ZCTA, NTA and borough boundaries)
+class OfflineGeocoder:
+    def __init__(self, zipcodes, neighborhoods, boroughs):
+        self.layers = {'zipcode': zipcodes, 'neighborhood': neighborhoods, 'borough': boroughs}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(PolygonLayer(config.get('geocoder', 'zipcodes'), config.get('geocoder', 'zipcode_property', fallback='ZCTA5CE10')),
+                   PolygonLayer(config.get('geocoder', 'neighborhoods'), config.get('geocoder', 'neighborhood_property', fallback='ntaname')),
+                   PolygonLayer(config.get('geocoder', 'boroughs'), config.get('geocoder', 'borough_property', fallback='boro_name')))
+
+    # Returns a df with zipcode, neighborhood and borough columns in the same order as the coordinates
+    def resolve(self, lat, lng):
+        return pd.DataFrame({column: layer.lookup(lat, lng) for column, layer in self.layers.items()})
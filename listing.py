@@ -0,0 +1,83 @@
+import re
+import requests
+import xml.etree.ElementTree as ET
+
+from datetime import datetime
+from retrying import retry
+from typing import NamedTuple
+
+
+# One object of the trip data bucket, size is in bytes and etag is the S3 ETag without its quotes
+class BucketEntry(NamedTuple):
+    key: str
+    size: int
+    last_modified: datetime
+    etag: str
+
+
+# Function to list every object of a S3 bucket with ListObjectsV2
+# S3 returns at most 1,000 keys per response, the next page is requested with the continuation token of the last one
+# Each response is parsed as it is downloaded, only the entries are kept and not the XML tree
+def list_bucket(bucket_url, prefix='', session=None):
+    session = session if session is not None else requests.Session()
+    token = None
+    while True:
+        params = {'list-type': 2, 'prefix': prefix}
+        if token is not None:
+            params['continuation-token'] = token
+        page = {}
+        yield from list_page(session, bucket_url, params, page)
+        if page.get('IsTruncated') != 'true' or not page.get('NextContinuationToken'):
+            return
+        token = page['NextContinuationToken']
+
+
+# Function to download and parse one page of a bucket listing, the other fields of the page are stored in page
+@retry(wait_fixed=5000, stop_max_attempt_number=3)
+def list_page(session, bucket_url, params, page):
+    entries = []
+    parser = ET.XMLPullParser(events=['end'])
+    with session.get(bucket_url, params=params, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                entries.extend(read_element(element, page))
+    parser.close()
+    return entries
+
+
+def read_element(element, page):
+    tag = element.tag.rsplit('}', 1)[-1]  # S3 puts every tag in its namespace
+    if tag == 'Contents':
+        fields = {child.tag.rsplit('}', 1)[-1]: child.text for child in element}
+        element.clear()  # The entry is copied, the tree doesn't need to keep it
+        yield BucketEntry(fields['Key'], int(fields['Size']),
+                          datetime.strptime(fields['LastModified'], '%Y-%m-%dT%H:%M:%S.%fZ'),
+                          (fields.get('ETag') or '').strip('"'))
+    elif tag in ('IsTruncated', 'NextContinuationToken'):
+        page[tag] = element.text
+
+
+# Function to find the months of trip data in a zip file from its key
+# Monthly files start with YYYYMM, and yearly archives with YYYY followed by a dash
+# Returns the first and last month as YYYYMM numbers, or None for other keys such as the Jersey City files starting with JC
+def trip_months(key):
+    match = re.match(r'(\d{4})(\d{2})?[-_]', key)
+    if match is None:
+        return None
+    year = int(match.group(1))
+    if match.group(2) is not None:
+        return year * 100 + int(match.group(2)), year * 100 + int(match.group(2))
+    return year * 100 + 1, year * 100 + 12
+
+
+# Function to keep the zip files with trip data between the start and end months (YYYY-MM, inclusive)
+# An empty end keeps every month from the start onwards
+def trip_zips(entries, start, end=''):
+    start = int(start.replace('-', ''))
+    end = int(end.replace('-', '')) if end else 999999
+    for entry in entries:
+        months = trip_months(entry.key)
+        if entry.key.endswith('.zip') and months is not None and months[0] <= end and months[1] >= start:
+            yield entry
@@ -0,0 +1,213 @@
+import numpy as np
+import os
+import pandas as pd
+import time
+
+from contextlib import nullcontext
+from datetime import datetime
+from retrying import retry
+
+
+# Tables loaded by the ETL, keyed by the name used in the log files
+# Each table lists its insert columns and their bind types, either 'number' or the max length of a varchar2 column from create.sql
+tables = {
+    'new bikes': ('admin.bikeusage_fact',
+                  ['bike_id', 'routepath_id', 'station_id_s', 'station_id_e', 'date_id', 'duration'],
+                  ['number', 120, 'number', 'number', 'number', 'number']),
+    'new bikes with route keys': ('admin.bikeusage_fact',
+                                  ['bike_id', 'routepath_id', 'station_id_s', 'station_id_e', 'date_id', 'duration'],
+                                  ['number', 'number', 'number', 'number', 'number', 'number']),
+    'new ridership': ('admin.ridership_fact',
+                      ['user_id', 'station_id_s', 'station_id_e', 'date_id', 'duration'],
+                      ['number', 'number', 'number', 'number', 'number']),
+    'historical stations': ('admin.station_dimension',
+                            ['station_id', 'station_name', 'station_latitude', 'station_longitude', 'zipcode', 'neighborhood', 'borough'],
+                            ['number', 70, 'number', 'number', 12, 50, 50]),
+    'station status': ('admin.station_status_fact',
+                       ['station_id', 'polled', 'reported', 'bikes_available', 'docks_available', 'is_renting'],
+                       ['number', 'number', 'number', 'number', 'number', 'number']),
+    'dates': ('admin.date_dimension',
+              ['date_id', 'ride_day', 'ride_week', 'ride_month', 'ride_year', 'weekdays'],
+              ['number', 'number', 'number', 'number', 'number', 10]),
+    'users': ('admin.user_dimension',
+              ['usertype', 'birth_year', 'age', 'gender', 'gendername'],
+              [10, 'number', 'number', 'number', 10]),
+    'users with ids': ('admin.user_dimension',
+                       ['user_id', 'usertype', 'birth_year', 'age', 'gender', 'gendername'],
+                       ['number', 10, 'number', 'number', 'number', 10]),
+    'new routes': ('admin.route_dimension',
+                   ['routepath_id', 'route_path_bor'],
+                   [120, 50]),
+    'new route keys': ('admin.route_dimension',
+                       ['routepath_id', 'route_path', 'route_path_bor'],
+                       ['number', 120, 50]),
+}
+
+
+# Generic batch loader used for every table in the tables dict
+# Bind types are declared with setinputsizes before each batch, so cx_Oracle doesn't have to infer them from the data
+# The first batch size is picked from the row width, then each batch is resized so it takes about batch_seconds,
+# based on the rows/sec measured for the previous batch of the same table
+# With max_bytes set, no batch is larger than max_bytes of bind data, whatever the rows/sec
+# With metrics set, every load and validate call is recorded as an insert or validate stage of the table
+class BulkLoader:
+    number_width = 22  # Max bytes of an Oracle NUMBER
+
+    def __init__(self, warehouse, connection, cur, batch_seconds=5, batch_bytes=8 * 1024 ** 2, max_batch=500000, min_batch=1000, max_bytes=None, metrics=None):
+        self.warehouse = warehouse
+        self.connection = connection
+        self.cur = cur
+        self.batch_seconds = batch_seconds
+        self.batch_bytes = batch_bytes
+        self.max_batch = max_batch
+        self.min_batch = min_batch
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self.batch_size = {}
+        self.rows = dict.fromkeys(tables, 0)
+        self.seconds = dict.fromkeys(tables, 0.0)
+
+    def row_width(self, name):
+        return sum(self.number_width if bind_type == 'number' else bind_type for bind_type in tables[name][2])
+
+    def largest_batch(self, name):
+        if self.max_bytes is None:
+            return self.max_batch
+        return max(self.min_batch, min(self.max_batch, self.max_bytes // self.row_width(name)))
+
+    # Function to insert all rows of data (a list of tuples) into a table, committing each batch
+    # With commit=False the rows are left in the open transaction, so the caller can commit them with other changes
+    # Returns the number of rows rejected by the DB
+    def load(self, name, data, current_file, commit=True):
+        if name not in self.batch_size:
+            self.batch_size[name] = max(self.min_batch, min(self.largest_batch(name), self.batch_bytes // self.row_width(name)))
+
+        bad_rows = 0
+        start = 0
+        with self.stage('insert', name, current_file, len(data)) as event:
+            while start < len(data):
+                batch = data[start:start + self.batch_size[name]]
+                start += len(batch)
+
+                batch_start = time.perf_counter()
+                bad_rows += self.insert_batch(name, batch, current_file, commit)
+                elapsed = time.perf_counter() - batch_start
+                self.rows[name] += len(batch)
+                self.seconds[name] += elapsed
+
+                # Aim the next batch at batch_seconds, moving half way there to smooth out one slow or fast round trip
+                if elapsed > 0:
+                    target = len(batch) / elapsed * self.batch_seconds
+                    self.batch_size[name] = int(max(self.min_batch, min(self.largest_batch(name), (self.batch_size[name] + target) / 2)))
+
+            event.update(rows=len(data), bytes=len(data) * self.row_width(name), errors=bad_rows)
+
+        if len(data) > 0:
+            print(f'{len(data) - bad_rows} rows have been inserted into {tables[name][0]}.')
+        return bad_rows
+
+    # Empty loads, e.g. a chunk without new dates, aren't recorded
+    def stage(self, stage, name, current_file, rows):
+        if self.metrics is None or rows == 0:
+            return nullcontext({})
+        return self.metrics.stage(stage, current_file, table=tables[name][0])
+
+    # The SQL insert statement is wrapped in a function to use the retry function
+    # The Oracle DB can return an error ORA-30036: unable to extend segment by 8 in undo
+    # This error is caused by the Oracle DB running out of tablespace in the undo table
+    # If an error is encountered, the code will wait 30 seconds before retrying and stop after 3 tries
+    # By allowing time to pass, it will allow the existing transaction to complete, so the entire batch is not lost
+    @retry(wait_fixed=30000, stop_max_attempt_number=3)
+    def insert_batch(self, name, batch, current_file, commit=True):
+        table, columns, bind_types = tables[name]
+        sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES({', '.join(f':{i + 1}' for i in range(len(columns)))})"
+        if not commit:
+            self.cur.execute('SAVEPOINT load_batch')  # Lets a bad batch be undone without losing the earlier batches of the transaction
+        self.cur.setinputsizes(*self.warehouse.input_sizes(bind_types))
+        self.cur.executemany(sql, batch, batcherrors=True)
+        batcherror = self.cur.getbatcherrors()
+        if len(batcherror) == 0:
+            if commit:
+                self.connection.commit()
+            return 0
+
+        # Remove bad records from the batch and write a log file to identify them for review
+        if commit:
+            self.connection.rollback()  # Roll back any transactions made prior to error
+        else:
+            self.cur.execute('ROLLBACK TO SAVEPOINT load_batch')
+        if not os.path.exists('./log'):
+            os.makedirs('./log')
+        f = open(f'./log/{name}.txt', 'a')
+        if len(batcherror) < 101:
+            # Write a log file with the SQL error and the offset positions
+            for error in batcherror:
+                f.write(f'{datetime.now()}, {current_file}, {error.message}, "at row offset, {error.offset}\n')
+            f.close()
+            print(f'Log file written with {len(batcherror)} errors to ./log/{name}.txt')
+
+            bad_obj = set(error.offset for error in batcherror)  # Positional values where an error was encountered
+            batch = [row for offset, row in enumerate(batch) if offset not in bad_obj]
+            self.cur.setinputsizes(*self.warehouse.input_sizes(bind_types))
+            self.cur.executemany(sql, batch)  # Rerun the SQL statement
+            if commit:
+                self.connection.commit()  # Commit the batch insert to the DB
+            print(f'{len(batch)} rows have been inserted into {table} with errors removed.')
+        else:
+            f.write(f'{datetime.now()}, {current_file}, Over 100 errors, will skip this batch \n')
+            f.close()
+            print(f'Over 100 errors in {current_file} with {name}, will skip this batch')
+        return len(batcherror) if len(batcherror) < 101 else len(batch)
+
+    # Function to drop the rows of a batch the DB would reject, so each batch goes through in a single round trip
+    # frame holds the table's columns in the order of the tables dict, foreign_keys maps a column name to its valid keys
+    # Checks are done once per unique value and applied to the rows with isin, so they stay vectorized
+    # Returns the rows that passed and the number of rows dropped, which are written to the table's log file
+    def validate(self, name, frame, current_file, foreign_keys=None):
+        foreign_keys = foreign_keys if foreign_keys is not None else {}
+        validate_start = time.perf_counter()
+        table, columns, bind_types = tables[name]
+        bad = pd.Series(False, index=frame.index)
+        reasons = []
+        for column, values, bind_type in zip(columns, frame.columns, bind_types):
+            col = frame[values]
+            unique = col.dropna().unique()
+            if bind_type == 'number':
+                # Oracle NUMBER can't store NaN or infinity, and tops out just below 1e126
+                numbers = pd.to_numeric(col, errors='coerce').to_numpy(dtype=float)
+                check = ~np.isfinite(numbers) | (np.abs(numbers) >= 1e125)
+                reason = 'not a valid number'
+            else:
+                # varchar2 lengths in create.sql are in bytes
+                too_long = [value for value in unique if len(str(value).encode('utf-8')) > bind_type]
+                check = col.isin(too_long).to_numpy()
+                reason = f'longer than {bind_type} bytes'
+            if column in foreign_keys:
+                keys = foreign_keys[column]
+                missing = [value for value in unique if value not in keys]
+                fk_check = col.isin(missing).to_numpy() | col.isna().to_numpy()
+                if fk_check.any():
+                    reasons.append(f'{fk_check.sum()} {column} not found in the parent table')
+                check = check & ~fk_check  # Count each row under one reason only
+                bad |= fk_check
+            if check.any():
+                reasons.append(f'{check.sum()} {column} {reason}')
+            bad |= check
+
+        bad_rows = int(bad.sum())
+        if bad_rows > 0:
+            if not os.path.exists('./log'):
+                os.makedirs('./log')
+            f = open(f'./log/{name}.txt', 'a')
+            f.write(f'{datetime.now()}, {current_file}, {bad_rows} rows dropped before insert: {"; ".join(reasons)}\n')
+            f.close()
+            print(f'{bad_rows} rows for {table} failed validation and were dropped, see ./log/{name}.txt')
+        if self.metrics is not None:
+            self.metrics.record('validate', current_file, {'table': table}, time.perf_counter() - validate_start,
+                                {'rows': frame.shape[0], 'bytes': 0, 'errors': bad_rows}, 'ok')
+        return frame[~bad.to_numpy()], bad_rows
+
+    # Returns one line per table with the rows inserted and the rows/sec, including time spent on retries and bad rows
+    def report(self):
+        return '\n'.join(f'{tables[name][0]}: {self.rows[name]} rows in {self.seconds[name]:.1f}s, {self.rows[name] / self.seconds[name]:.0f} rows/sec'
+                         for name in tables if self.seconds[name] > 0)
@@ -0,0 +1,96 @@
+import os
+import pandas as pd
+import re
+import time
+
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:  # psutil is optional, /proc/self/statm is read instead on Linux
+    psutil = None
+
+
+# Function to convert a size such as 4G, 512M or 2000000 (bytes) to a number of bytes
+def parse_size(size):
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)B?\s*', str(size), flags=re.IGNORECASE)
+    if match is None:
+        raise ValueError(f'Invalid memory size {size}, use a number of bytes or a value such as 512M or 4G')
+    return int(float(match.group(1)) * 1024 ** ' KMGT'.index(match.group(2).upper() or ' '))
+
+
+# Returns the resident memory of the current process in bytes
+def rss():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+# Function to downcast the numeric ride columns to the smallest type that holds their values
+# Coordinates stay float64, float32 would move the stations by up to a meter
+def downcast(df):
+    for column in ['tripduration', 'bikeid', 'gender']:
+        if column in df.columns and df[column].dtype.kind == 'i':
+            df[column] = pd.to_numeric(df[column], downcast='integer')
+    if 'birth year' in df.columns:
+        df['birth year'] = df['birth year'].astype('float32')  # Years are exact in float32
+    return df
+
+
+# Memory budget of one process, used by the --max-memory mode of etl_rides.py
+# Each stage of a chunk is wrapped in stage(), which records the resident memory it added, the peak gives the cost of a row
+# The next chunk is sized so the process stays under max_bytes, starting from first_rows and never going under min_rows
+class MemoryBudget:
+    def __init__(self, max_bytes, first_rows=100000, min_rows=10000, max_rows=2000000, headroom=0.8):
+        self.max_bytes = max_bytes
+        self.rows = first_rows
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.headroom = headroom  # Share of the budget planned for, the rest covers what the samples miss
+        self.stage_bytes = {}
+        self.stage_seconds = {}
+        self.row_bytes = 0
+        self.chunk_start = None
+        self.chunk_peak = 0
+
+    @contextmanager
+    def stage(self, name):
+        before = rss()
+        if self.chunk_start is None:
+            self.chunk_start = before
+        start = time.perf_counter()
+        yield
+        after = rss()
+        self.chunk_peak = max(self.chunk_peak, after)
+        self.stage_bytes[name] = max(self.stage_bytes.get(name, 0), after - before)
+        self.stage_seconds[name] = self.stage_seconds.get(name, 0) + time.perf_counter() - start
+
+    # Returns the number of rows to read for the next chunk
+    def chunk_rows(self):
+        return self.rows
+
+    # Function called once a chunk of rows went through every stage, to size the next chunk
+    # Memory freed by a chunk is usually kept by the process and reused by the next one, so resident memory rarely goes down
+    # The cost of a row is the largest seen so far, and the memory of the last chunk counts as available to the next
+    def end_chunk(self, rows):
+        current = rss()
+        if self.chunk_start is not None and rows > 0:
+            self.row_bytes = max(self.row_bytes, (self.chunk_peak - self.chunk_start) / rows, 1)
+            next_rows = rows + (self.max_bytes * self.headroom - current) / self.row_bytes
+            # Grow at most twice as fast as the last chunk, a single small chunk gives a noisy estimate
+            self.rows = int(max(self.min_rows, min(self.max_rows, 2 * rows, next_rows)))
+            if current > self.max_bytes:
+                print(f'Memory use of {current / 1024 ** 2:.0f}MB is over the budget of {self.max_bytes / 1024 ** 2:.0f}MB, '
+                      f'reading {self.rows} rows at a time')
+        self.chunk_start = None
+        self.chunk_peak = 0
+
+    # Memory allowed for the bind arrays of one batch insert, a tenth of the budget
+    def batch_bytes(self):
+        return int(self.max_bytes * 0.1)
+
+    # Returns one line per stage with the most resident memory it added to a chunk, and its total time
+    def report(self):
+        return '\n'.join(f'{name}: +{self.stage_bytes[name] / 1024 ** 2:.1f}MB peak, {self.stage_seconds[name]:.1f}s'
+                         for name in self.stage_bytes)
@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+
+# Structured metrics of the ETL stages, for the scheduler to alert on and to see where a run spends its time
+# Every stage run is written as one JSON line to the events file: stage, file, seconds, rows, bytes, errors and status
+# The totals per stage are also written in the Prometheus text format, for the node_exporter textfile collector
+# Stages can run in several threads at the same time, e.g. the download and load stages of etl_rides.py
+class Metrics:
+    def __init__(self, job, events=None, textfile_dir=None):
+        self.job = job
+        self.events = events
+        self.textfile_dir = textfile_dir
+        self.run = f'{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}'
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.profiler = None  # Set to a Profiler by --profile, every stage is then profiled too
+        self.last_success = self.read_last_success()
+        if events and os.path.dirname(events) and not os.path.exists(os.path.dirname(events)):
+            os.makedirs(os.path.dirname(events))
+
+    # Settings from the [metrics] section of config.ini, events are written to ./log/metrics.jsonl by default
+    @classmethod
+    def from_config(cls, config, job):
+        return cls(job, config.get('metrics', 'events', fallback='./log/metrics.jsonl') or None,
+                   config.get('metrics', 'textfile_dir', fallback='') or None)
+
+    # Times a stage, the caller fills in the rows, bytes and errors of the yielded event
+    # A stage that turned out to have nothing to do, e.g. a read at the end of a file, sets event['skipped'] and isn't recorded
+    # file is only written to the events, the other labels are also used to break down the Prometheus totals, e.g. the table name
+    @contextmanager
+    def stage(self, name, file=None, **labels):
+        event = {'rows': 0, 'bytes': 0, 'errors': 0}
+        start = time.perf_counter()
+        try:
+            with self.profiler.stage(name, file) if self.profiler is not None else nullcontext():
+                yield event
+        except BaseException as e:
+            self.record(name, file, labels, time.perf_counter() - start, event, 'failed', repr(e))
+            raise
+        if not event.get('skipped'):
+            self.record(name, file, labels, time.perf_counter() - start, event, 'ok')
+
+    def record(self, name, file, labels, seconds, event, status, error=None):
+        line = {'time': datetime.now().isoformat(timespec='milliseconds'), 'job': self.job, 'run': self.run, 'stage': name,
+                **labels, 'file': file, 'seconds': round(seconds, 6), 'rows': int(event['rows']), 'bytes': int(event['bytes']),
+                'errors': int(event['errors']), 'status': status}
+        if error is not None:
+            line['error'] = error
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            total = self.totals.setdefault(key, {'runs': 0, 'failures': 0, 'seconds': 0, 'rows': 0, 'bytes': 0, 'errors': 0})
+            total['runs'] += 1
+            total['failures'] += status != 'ok'
+            total['seconds'] += seconds
+            for field in ['rows', 'bytes', 'errors']:
+                total[field] += line[field]
+            if self.events:
+                with open(self.events, 'a') as f:
+                    f.write(json.dumps(line) + '\n')
+
+    # Returns the totals recorded since the last call and starts over, used to send the totals of a worker process to the main one
+    def take(self):
+        with self.lock:
+            totals, self.totals = self.totals, {}
+        return totals
+
+    def merge(self, totals):
+        with self.lock:
+            for key, values in totals.items():
+                total = self.totals.setdefault(key, dict.fromkeys(values, 0))
+                for field, value in values.items():
+                    total[field] += value
+
+    # Function to write the totals to <textfile_dir>/citibike_<job>.prom, replaced atomically so the collector never reads half a file
+    def write_textfile(self, success=False):
+        if not self.textfile_dir:
+            return
+        if not os.path.exists(self.textfile_dir):
+            os.makedirs(self.textfile_dir)
+        lines = []
+        with self.lock:
+            for field, kind, help_text in [('runs', 'counter', 'Number of times the stage ran'),
+                                           ('failures', 'counter', 'Number of times the stage raised an error'),
+                                           ('seconds', 'counter', 'Time spent in the stage'),
+                                           ('rows', 'counter', 'Rows processed by the stage'),
+                                           ('bytes', 'counter', 'Bytes processed by the stage'),
+                                           ('errors', 'counter', 'Rows rejected by the stage')]:
+                metric = f'citibike_etl_stage_{field}_total'
+                lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} {kind}']
+                lines += [f'{metric}{{{self.labels(name, labels)}}} {total[field]:g}' for (name, labels), total in sorted(self.totals.items())]
+            lines += ['# HELP citibike_etl_stage_rows_per_second Rows processed per second of stage time',
+                      '# TYPE citibike_etl_stage_rows_per_second gauge']
+            lines += [f'citibike_etl_stage_rows_per_second{{{self.labels(name, labels)}}} {total["rows"] / total["seconds"]:g}'
+                      for (name, labels), total in sorted(self.totals.items()) if total['seconds'] > 0]
+        lines += ['# HELP citibike_etl_last_update_timestamp_seconds Time the metrics were written',
+                  '# TYPE citibike_etl_last_update_timestamp_seconds gauge',
+                  f'citibike_etl_last_update_timestamp_seconds{{job="{self.job}"}} {time.time():.0f}']
+        if success:
+            self.last_success = time.time()
+        if self.last_success is not None:
+            lines += ['# HELP citibike_etl_last_success_timestamp_seconds Time the last run finished without an error',
+                      '# TYPE citibike_etl_last_success_timestamp_seconds gauge',
+                      f'citibike_etl_last_success_timestamp_seconds{{job="{self.job}"}} {self.last_success:.0f}']
+
+        path = self.textfile_path()
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+    def textfile_path(self):
+        return os.path.join(self.textfile_dir, f'citibike_{self.job}.prom')
+
+    # The last success of an earlier run is kept, so the gauge doesn't disappear while the next run is in progress
+    def read_last_success(self):
+        if not self.textfile_dir or not os.path.exists(self.textfile_path()):
+            return None
+        with open(self.textfile_path()) as f:
+            for line in f:
+                if line.startswith('citibike_etl_last_success_timestamp_seconds'):
+                    return float(line.split()[-1])
+        return None
+
+    def labels(self, name, labels):
+        return ','.join(f'{key}="{escape(value)}"' for key, value in [('job', self.job), ('stage', name)] + list(labels))
+
+
+# Function to escape a Prometheus label value
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,94 @@
+import queue
+import threading
+
+
+# Building blocks to run the stages of the ETL at the same time, connected by bounded queues
+# A full queue blocks the stage putting items into it, so a fast stage waits for a slow one instead of filling up memory
+# An error in a background stage is raised again in the main thread the next time it touches the queue
+
+done = object()  # Put after the last item of a queue
+
+
+class StageFailed:
+    def __init__(self, error):
+        self.error = error
+
+
+# Function to run a generator in a background thread, at most maxsize items ahead of the caller
+# Yields the same items as the generator, e.g. the zip files being downloaded while the previous one is transformed
+def prefetch(generator, maxsize=1):
+    items = queue.Queue(maxsize)
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            for item in generator:
+                if not put(items, item, stopped):
+                    return
+            put(items, done, stopped)
+        except BaseException as e:
+            put(items, StageFailed(e), stopped)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            if isinstance(item, StageFailed):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()  # Lets the producer give up if the caller stops early
+        thread.join()
+
+
+# Function to put an item in a bounded queue, waiting until there is room or the other side has stopped
+# Returns False if the item was dropped because the other side stopped
+def put(items, item, stopped):
+    while not stopped.is_set():
+        try:
+            items.put(item, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+# Runs consume(items) in a background thread, where items iterates over everything passed to put()
+# close() waits for the thread to finish and returns the value returned by consume
+class Drain:
+    def __init__(self, consume, maxsize=4):
+        self.items = queue.Queue(maxsize)
+        self.stopped = threading.Event()
+        self.result = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(consume,), daemon=True)
+        self.thread.start()
+
+    def __iter__(self):
+        while True:
+            item = self.items.get()
+            if item is done:
+                return
+            yield item
+
+    def run(self, consume):
+        try:
+            self.result = consume(iter(self))
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.stopped.set()
+
+    def put(self, item):
+        if not put(self.items, item, self.stopped):
+            self.close()  # The consumer stopped, raise its error
+
+    def close(self):
+        put(self.items, done, self.stopped)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
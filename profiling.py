@@ -0,0 +1,155 @@
+import cProfile
+import os
+import pstats
+import re
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from datetime import datetime
+
+
+# Profiling mode of the ETL scripts, turned on with --profile or --profile-memory
+# Every file gets a <file>.stages.txt in the profile folder, with the calls and seconds of each of its stages
+# With --profile each stage is run under cProfile, and every file also gets:
+#   <file>.pstats with the calls of all its stages, and <file>.<stage>.pstats for each stage, to open with pstats or snakeviz
+# With --profile-memory tracemalloc runs instead of cProfile, the two aren't combined since tracing memory slows everything down
+# and its overhead would end up in the timings. The stages.txt then also has the peak traced memory of each stage,
+# and the top allocation sites still holding memory at the end of the file
+# tracemalloc keeps memory_frames frames of each allocation, 1 is the cheapest but points into pandas and numpy,
+# with more frames the sites are reported at the first line of this repo in their traceback, e.g. a to_records().tolist() line
+# Tracing starts over with each file, so the peaks and sites only count the memory allocated since the file started
+# Only the stages of the main thread are profiled, but tracemalloc sees the whole process,
+# so the memory of the download and load threads running at the same time is in the peaks and sites too
+class Profiler:
+    def __init__(self, path='./profile', memory_frames=None, top=25):
+        self.path = os.path.join(path, f'{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}')
+        os.makedirs(self.path)
+        self.memory_frames = memory_frames  # None profiles the time with cProfile, a number of frames traces the memory
+        self.top = top
+        self.names = {}
+        self.repo = os.path.dirname(os.path.abspath(__file__))
+        self.ignored = {module.__file__ for module in [tracemalloc, cProfile, pstats]} | {__file__}  # Memory of the profiler itself
+        self.current_file = None
+        self.profiles = {}
+        self.seconds = {}
+        self.peaks = {}
+        self.calls = {}
+        self.stack = []  # [key, start time, seconds of the stages inside it] of the stages running in the main thread, the innermost last
+
+    # Profiles a stage, a stage started inside another one is profiled on its own and left out of the outer stage's time
+    @contextmanager
+    def stage(self, name, file=None):
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        if (self.current_file is None or file is not None and file != self.current_file) and not self.stack:
+            self.start_file(file or name)
+
+        key = (self.current_file, name)
+        if self.stack:
+            self.pause(self.stack[-1][0])
+        self.calls[key] = self.calls.get(key, 0) + 1
+        self.stack.append([key, time.perf_counter(), 0])
+        if self.memory_frames is None:
+            profile = self.profiles.setdefault(key, cProfile.Profile())
+            profile.enable()
+        else:
+            reset_peak()
+        try:
+            yield
+        finally:
+            if self.memory_frames is None:
+                profile.disable()
+            _, start, inner = self.stack.pop()
+            seconds = time.perf_counter() - start
+            self.seconds[key] = self.seconds.get(key, 0) + seconds - inner
+            if self.memory_frames is not None:
+                peak = tracemalloc.get_traced_memory()[1]
+                self.peaks[key] = max(self.peaks.get(key, 0), peak)
+            if self.stack:
+                outer = self.stack[-1]
+                outer[2] += seconds
+                if self.memory_frames is None:
+                    self.profiles[outer[0]].enable()
+                else:
+                    # The outer stage's peak includes the memory of the stages inside it
+                    self.peaks[outer[0]] = max(self.peaks.get(outer[0], 0), peak)
+                    reset_peak()
+
+    def pause(self, key):
+        if self.memory_frames is None:
+            self.profiles[key].disable()
+        else:
+            self.peaks[key] = max(self.peaks.get(key, 0), tracemalloc.get_traced_memory()[1])
+
+    def start_file(self, file):
+        self.finish()
+        self.current_file = file
+        if self.memory_frames is not None:
+            tracemalloc.stop()
+            tracemalloc.start(self.memory_frames)
+            self.start_snapshot = tracemalloc.take_snapshot()
+
+    # Function to write the profiles of the current file, called when the next file starts and at the end of the run
+    def finish(self):
+        if self.current_file is None:
+            return
+        name = re.sub(r'[^\w.-]+', '_', os.path.basename(self.current_file))
+        self.names[name] = self.names.get(name, 0) + 1
+        if self.names[name] > 1:  # The same file was loaded again, e.g. from the staging cache
+            name = f'{name}.{self.names[name]}'
+        keys = [key for key in self.calls if key[0] == self.current_file]
+
+        stats = None
+        for key in keys:
+            if key not in self.profiles or not self.profiles[key].getstats():
+                continue
+            self.profiles[key].dump_stats(os.path.join(self.path, f'{name}.{key[1]}.pstats'))
+            if stats is None:
+                stats = pstats.Stats(self.profiles[key])
+            else:
+                stats.add(self.profiles[key])
+        if stats is not None:
+            stats.dump_stats(os.path.join(self.path, f'{name}.pstats'))
+
+        with open(os.path.join(self.path, f'{name}.stages.txt'), 'w') as f:
+            memory = self.memory_frames is not None
+            f.write(f'{self.current_file}\n\nstage                  calls    seconds' + ('   peak traced MB\n' if memory else '\n'))
+            for key in keys:
+                f.write(f'{key[1]:20} {self.calls[key]:7} {self.seconds[key]:10.2f}' + (f' {self.peaks.get(key, 0) / 1024 ** 2:16.1f}\n' if memory else '\n'))
+            if memory:
+                f.write(f'\nTop {self.top} allocation sites still holding memory at the end of the file, against the start of the file\n')
+                f.write(''.join(line + '\n' for line in self.allocation_sites(tracemalloc.take_snapshot().compare_to(self.start_snapshot, 'traceback'))))
+
+        for key in keys:
+            for values in [self.profiles, self.seconds, self.peaks, self.calls]:
+                values.pop(key, None)
+        self.current_file = None
+        self.start_snapshot = None
+        tracemalloc.stop()
+
+    # Function to group allocations by their first frame in this repo, returns the top lines
+    def allocation_sites(self, differences):
+        sites = {}
+        for difference in differences:
+            if difference.size_diff == 0:
+                continue
+            frames = list(reversed(difference.traceback))  # Most recent call first
+            if frames[0].filename in self.ignored or frames[0].filename.startswith('<frozen'):  # The profiler itself, and imports
+                continue
+            frame = next((frame for frame in frames if frame.filename.startswith(self.repo)), frames[0])
+            site = sites.setdefault((frame.filename, frame.lineno), [0, 0, frames[0]])
+            site[0] += difference.size_diff
+            site[1] += difference.count_diff
+        top = sorted(sites.items(), key=lambda item: item[1][0], reverse=True)[:self.top]
+        return [f'{size / 1024 ** 2:+10.2f} MB {count:+9} blocks  {os.path.relpath(filename, self.repo) if filename.startswith(self.repo) else filename}:{lineno}'
+                + (f'  (in {os.path.basename(inner.filename)}:{inner.lineno})' if (inner.filename, inner.lineno) != (filename, lineno) else '')
+                for (filename, lineno), (size, count, inner) in top]
+
+
+# tracemalloc.reset_peak is new in Python 3.9, on older versions the peak is the highest since the file started
+def reset_peak():
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
@@ -0,0 +1,27 @@
+-- Route tables used with route_keys = stations in the [etl] section of config.ini
+-- RoutePath_ID is computed from the start and end station ids, the readable route is kept in Route_Path
+-- Run after create.sql, it replaces the route and bike usage tables
+DROP TABLE BikeUsage_Fact;
+DROP TABLE Route_Dimension;
+
+CREATE TABLE Route_Dimension(
+RoutePath_ID		number,
+Route_Path			varchar2(120),
+Route_Path_Bor		varchar2(50),
+primary key (RoutePath_ID)
+);
+
+CREATE TABLE BikeUsage_Fact (
+BikeUsage_ID		number GENERATED BY DEFAULT ON NULL AS IDENTITY,
+Bike_ID				number,
+RoutePath_ID		number,
+Station_ID_S		number,
+Station_ID_E		number,
+Date_ID				number,
+Duration			number,
+primary key (BikeUsage_ID),
+foreign key(RoutePath_ID) references Route_Dimension(RoutePath_ID),
+foreign key(Station_ID_S) references Station_Dimension(Station_ID),
+foreign key(Station_ID_E) references Station_Dimension(Station_ID),
+foreign key(Date_ID) references Date_Dimension(Date_ID)
+);
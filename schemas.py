@@ -0,0 +1,145 @@
+import csv
+import numpy as np
+import pandas as pd
+
+
+# Columns of the cleaned rides used by the transforms, in the order of the CSV files
+ride_columns = ['tripduration', 'starttime', 'stoptime',
+                'start station id', 'start station name', 'start station latitude', 'start station longitude',
+                'end station id', 'end station name', 'end station latitude', 'end station longitude',
+                'bikeid', 'usertype', 'birth year', 'gender']
+
+# Types of the ride columns once they are read, station names and user types repeat a lot so they are categories
+# Columns that can hold missing values are floats
+# The coerced columns have dirty values in some files, e.g. an empty bike id or a birth year of Unknown
+# They are read with these types and the known dirty values as missing, and a chunk with any other bad value is read again
+# with them as strings and converted with to_numeric, so a bad value becomes NaN instead of failing the whole file
+ride_dtypes = {'tripduration': 'int64',
+               'start station id': 'float64', 'start station name': 'category',
+               'start station latitude': 'float64', 'start station longitude': 'float64',
+               'end station id': 'float64', 'end station name': 'category',
+               'end station latitude': 'float64', 'end station longitude': 'float64',
+               'bikeid': 'float64', 'usertype': 'category', 'birth year': 'float64', 'gender': 'int8'}
+coerced = ['start station id', 'end station id', 'bikeid', 'birth year', 'gender']
+
+
+# Layout of one generation of the Citibike trip data CSV files
+# columns maps each header name of the file to its ride column, timestamps lists the formats used by that generation
+# Files of the same generation don't always share a timestamp format, so each chunk uses the first format that parses it
+class TripSchema:
+    def __init__(self, name, columns, timestamps, dtypes=None, derive=None):
+        self.name = name
+        self.columns = columns
+        self.timestamps = timestamps
+        self.dtypes = dtypes if dtypes is not None else {column: ride_dtypes[ride_column]
+                                                         for column, ride_column in columns.items() if ride_column in ride_dtypes}
+        self.coerced_dtypes = {column: 'str' if columns[column] in coerced else dtype for column, dtype in self.dtypes.items()}
+        self.na_values = {column: ['NULL', '\\N'] + (['Unknown'] if ride_column in coerced else []) for column, ride_column in columns.items()}
+        self.derive = derive  # Function to compute the ride columns missing from this generation
+
+    def matches(self, header):
+        return set(self.columns) <= set(header)
+
+    # Function to open a reader over the rest of a CSV file after its header line, with only the columns and types of this layout
+    # Chunks of any size are read with reader.get_chunk(rows), and turned into the ride columns with normalize()
+    # The first skiprows rows are skipped without being parsed
+    # With coerce, the coerced columns are read as strings, for the files where a typed chunk raised a ValueError
+    def reader(self, fileobj, header, skiprows=0, coerce=False):
+        return pd.read_csv(fileobj, encoding='cp1252', header=None, names=header, usecols=list(self.columns),
+                           dtype=self.coerced_dtypes if coerce else self.dtypes, na_values=self.na_values,
+                           skiprows=skiprows, iterator=True)
+
+    def normalize(self, df):
+        df = df.rename(columns=self.columns)
+        for column in coerced:
+            if column in df.columns and df[column].dtype == object:
+                df[column] = pd.to_numeric(df[column], errors='coerce')
+                # Every chunk gets the same type, whether or not it had a bad value, and 0 is the unknown gender of the trip data
+                df[column] = df[column].fillna(0).astype('int8') if column == 'gender' else df[column].astype(ride_dtypes[column])
+        # The stop time is only parsed for the layouts that derive the trip duration from it, the others keep it as read
+        for column in ['starttime', 'stoptime'] if self.derive is not None else ['starttime']:
+            df[column] = parse_timestamps(df[column], self.timestamps)
+        if self.derive is not None:
+            df = self.derive(df)
+        df['usertype'] = df['usertype'].cat.add_categories([''] if '' not in df['usertype'].cat.categories else []).fillna('')
+        return df[ride_columns]
+
+
+# Function to parse timestamps with the first of the formats that fits the whole column
+# Falls back to the slower inferred format if none of them does
+def parse_timestamps(values, formats):
+    for timestamp_format in formats:
+        try:
+            return pd.to_datetime(values, format=timestamp_format)
+        except ValueError:
+            pass
+    return pd.to_datetime(values)
+
+
+# The ride columns are named the same way from 2013-07 to 2016-09 and again from 2017-04 to 2021-01
+# Only the timestamps differ: 2014-09 to 2016-09 are m/d/Y, sometimes without seconds, and 2018 onwards has milliseconds
+lowercase = {column: column for column in ride_columns}
+
+# From 2016-10 to 2017-03 the columns are in title case
+title_case = {'Trip Duration': 'tripduration',
+              'Start Time': 'starttime',
+              'Stop Time': 'stoptime',
+              'Start Station ID': 'start station id',
+              'Start Station Name': 'start station name',
+              'Start Station Latitude': 'start station latitude',
+              'Start Station Longitude': 'start station longitude',
+              'End Station ID': 'end station id',
+              'End Station Name': 'end station name',
+              'End Station Latitude': 'end station latitude',
+              'End Station Longitude': 'end station longitude',
+              'Bike ID': 'bikeid',
+              'User Type': 'usertype',
+              'Birth Year': 'birth year',
+              'Gender': 'gender'}
+
+# From 2021-02 the files have ride ids, station ids that are not always numbers, and no bike id, birth year or gender
+ride_ids = {'started_at': 'starttime',
+            'ended_at': 'stoptime',
+            'start_station_id': 'start station id',
+            'start_station_name': 'start station name',
+            'start_lat': 'start station latitude',
+            'start_lng': 'start station longitude',
+            'end_station_id': 'end station id',
+            'end_station_name': 'end station name',
+            'end_lat': 'end station latitude',
+            'end_lng': 'end station longitude',
+            'member_casual': 'usertype'}
+
+
+# Function to fill in the ride columns of the 2021-02 layout
+# Station ids that are not numbers are left missing and dropped as bad station data, like rides without a station
+# Rides without a bike id are kept for Ridership_Fact but can't be loaded into BikeUsage_Fact
+def derive_ride_ids(df):
+    df['tripduration'] = (df['stoptime'] - df['starttime']).dt.total_seconds().astype('int64')
+    df['usertype'] = df['usertype'].cat.rename_categories({'member': 'Subscriber', 'casual': 'Customer'})
+    df['bikeid'] = np.nan
+    df['birth year'] = np.nan
+    df['gender'] = np.int8(0)
+    return df
+
+
+# Known layouts, the first one whose columns are all in the header is used
+schemas = [
+    TripSchema('lowercase', lowercase, ['%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%m/%d/%Y %H:%M:%S', '%m/%d/%Y %H:%M']),
+    TripSchema('title case', title_case, ['%Y-%m-%d %H:%M:%S', '%m/%d/%Y %H:%M:%S']),
+    TripSchema('ride ids', ride_ids, ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f'],
+               dtypes={'start_station_id': 'str', 'start_station_name': 'category', 'start_lat': 'float64', 'start_lng': 'float64',
+                       'end_station_id': 'str', 'end_station_name': 'category', 'end_lat': 'float64', 'end_lng': 'float64',
+                       'member_casual': 'category'},
+               derive=derive_ride_ids),
+]
+
+
+# Function to parse the header line of a CSV file and find its layout
+# Returns the header names and the schema, which is None for an unknown layout
+def detect_schema(header_line):
+    header = next(csv.reader([header_line.strip()]))
+    for schema in schemas:
+        if schema.matches(header):
+            return header, schema
+    return header, None
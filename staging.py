@@ -0,0 +1,61 @@
+import json
+import os
+import pandas as pd
+import shutil
+
+
+# Local cache of the cleaned rides of each zip file, stored as one Parquet file per chunk
+# Entries are keyed by the zip file name and its content hash (the S3 ETag), so a zip file replaced on S3 is staged again
+# The manifest listing the chunks is written last, so a zip file that was only partly staged is never read back
+# pandas needs pyarrow (or fastparquet) installed to read and write Parquet files
+class StagingCache:
+    def __init__(self, path='./staging'):
+        self.path = path
+
+    def folder(self, zip_filename, content_hash):
+        return os.path.join(self.path, zip_filename.rsplit('.', 1)[0], content_hash)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.folder(*key), 'manifest.json'))
+
+    # Yields (filename, row offset, df, bad records) for each staged chunk, only reading the given columns from the Parquet files
+    # The row offset counts the rows of the CSV file before the chunk, including the bad records dropped when it was cleaned
+    def read(self, zip_filename, content_hash, columns=None):
+        folder = self.folder(zip_filename, content_hash)
+        with open(os.path.join(folder, 'manifest.json')) as f:
+            manifest = json.load(f)
+        offsets = {}
+        for chunk in manifest['chunks']:
+            offset = offsets.get(chunk['filename'], 0)
+            offsets[chunk['filename']] = offset + chunk['rows'] + chunk['bad_records']
+            yield chunk['filename'], offset, pd.read_parquet(os.path.join(folder, chunk['path']), columns=columns), chunk['bad_records']
+
+    def writer(self, zip_filename, content_hash):
+        return StagingWriter(self, zip_filename, content_hash)
+
+
+# Writes the chunks of one zip file as they are cleaned, commit() makes them visible to StagingCache.read
+class StagingWriter:
+    def __init__(self, cache, zip_filename, content_hash):
+        self.archive = os.path.dirname(cache.folder(zip_filename, content_hash))
+        self.folder = cache.folder(zip_filename, content_hash)
+        if os.path.exists(self.folder):  # Left behind by a run that stopped part way
+            shutil.rmtree(self.folder)
+        os.makedirs(self.folder)
+        self.chunks = []
+
+    def add(self, filename, df, bad_records):
+        path = f'{len(self.chunks):05d}.parquet'
+        df.to_parquet(os.path.join(self.folder, path), index=False)
+        self.chunks.append({'filename': filename, 'path': path, 'rows': df.shape[0], 'bad_records': bad_records})
+
+    def commit(self):
+        manifest_path = os.path.join(self.folder, 'manifest.json')
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump({'chunks': self.chunks}, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+        # Older versions of the same zip file won't be read again
+        for content_hash in os.listdir(self.archive):
+            if os.path.join(self.archive, content_hash) != self.folder:
+                shutil.rmtree(os.path.join(self.archive, content_hash))
@@ -0,0 +1,15 @@
+-- Row hash and staging table used by etl_station_city.py to merge the station feed into Station_Dimension
+-- create.sql already has them, run this once on a warehouse created before
+ALTER TABLE Station_Dimension ADD Row_Hash varchar2(32);
+
+CREATE GLOBAL TEMPORARY TABLE Station_Staging(
+Station_ID			number not null,
+Station_name		varchar2(70),
+Station_latitude	number,
+Station_longitude	number,
+Zipcode				varchar2(12),
+Neighborhood		varchar2(50),
+Borough				varchar2(50),
+Row_Hash			varchar2(32),
+primary key(Station_ID)
+) ON COMMIT DELETE ROWS;
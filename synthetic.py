@@ -0,0 +1,194 @@
+import argparse
+import json
+import numpy as np
+import os
+import pandas as pd
+import time
+
+from schemas import title_case
+from zipfile import ZIP_DEFLATED, ZipFile
+
+
+# Synthetic Citibike trip data, to benchmark and test the ETL without downloading the real files
+# Stations, trips and the GBFS station feeds are random but shaped like the real data, and the same seed gives the same files
+# Run python synthetic.py --help to write a set of files, benchmark.py uses the same functions
+
+# Header of each generation of the trip data CSV files, with the timestamp format it used
+# The 2018 files have timestamps with 4 decimals of seconds, written as %f and cut to 4 digits
+lowercase_header = ['tripduration', 'starttime', 'stoptime',
+                    'start station id', 'start station name', 'start station latitude', 'start station longitude',
+                    'end station id', 'end station name', 'end station latitude', 'end station longitude',
+                    'bikeid', 'usertype', 'birth year', 'gender']
+ride_ids_header = ['ride_id', 'rideable_type', 'started_at', 'ended_at', 'start_station_name', 'start_station_id',
+                   'end_station_name', 'end_station_id', 'start_lat', 'start_lng', 'end_lat', 'end_lng', 'member_casual']
+eras = {'2014-09': (lowercase_header, '%m/%d/%Y %H:%M:%S'),
+        '2016-10': (list(title_case), '%Y-%m-%d %H:%M:%S'),
+        '2018-01': (lowercase_header, '%Y-%m-%d %H:%M:%S.%f'),
+        '2021-02': (ride_ids_header, '%Y-%m-%d %H:%M:%S')}
+
+# Area covered by the stations, roughly Manhattan, Brooklyn and Queens
+min_lat, max_lat = 40.65, 40.82
+min_lng, max_lng = -74.02, -73.90
+
+streets = ['Broadway', 'W 21 St', 'E 17 St', 'Allen St', 'Pike St', 'Bedford Ave', 'Atlantic Ave', 'Court St',
+           'Grand St', 'Vernon Blvd', 'Lafayette St', 'Henry St', 'Clinton St', 'Franklin Ave', 'Myrtle Ave']
+avenues = ['1 Ave', '2 Ave', '6 Ave', '8 Ave', 'Park Ave', 'Lexington Ave', 'Amsterdam Ave', 'Columbus Ave']
+
+
+# Function to create count stations with an id, name and location
+def make_stations(count, seed=0):
+    rng = np.random.default_rng(seed)
+    ids = 72 + np.arange(count) * 3  # The real station ids have gaps
+    names = [f'{streets[i % len(streets)]} & {avenues[(i // len(streets)) % len(avenues)]}' + (f' {i}' if i >= len(streets) * len(avenues) else '')
+             for i in range(count)]
+    return pd.DataFrame({'station id': ids, 'station name': names,
+                         'station latitude': rng.uniform(min_lat, max_lat, count).round(8),
+                         'station longitude': rng.uniform(min_lng, max_lng, count).round(8)})
+
+
+# Function to create the rides of one month in the header layout of an era, as strings like in the CSV files
+# A dirty_rate share of the rides has a missing station, a station at 0,0 or a missing birth year, like the bad records of the real files
+def make_trips(stations, rows, era='2018-01', month='2018-01', dirty_rate=0.01, seed=0):
+    header, timestamp_format = eras[era]
+    rng = np.random.default_rng(seed)
+    start = stations.iloc[rng.integers(0, len(stations), rows)].reset_index(drop=True)
+    end = stations.iloc[rng.integers(0, len(stations), rows)].reset_index(drop=True)
+    month_start = pd.Timestamp(month + '-01')
+    month_ms = int(((month_start + pd.offsets.MonthBegin(1)) - month_start).total_seconds() * 1000)
+    starttime = month_start + pd.to_timedelta(np.sort(rng.integers(0, month_ms, rows)), unit='ms')
+    duration = rng.lognormal(6.5, 0.8, rows).astype('int64') + 61  # Most rides take 5 to 30 minutes
+    stoptime = starttime + pd.to_timedelta(duration, unit='s')
+    usertype = np.where(rng.random(rows) < 0.85, 'Subscriber', 'Customer')
+
+    timestamps = [pd.Series(values).dt.strftime(timestamp_format) for values in (starttime, stoptime)]
+    if timestamp_format.endswith('%f'):
+        timestamps = [values.str.slice(stop=-2) for values in timestamps]
+
+    start_ids = start['station id'].astype(str)
+    end_ids = end['station id'].astype(str)
+    start_lat, start_lng = start['station latitude'].copy(), start['station longitude'].copy()
+    birth_year = pd.Series(rng.integers(1940, 2004, rows)).astype(str)
+
+    # Each dirty ride gets one of the problems found in the real files
+    dirty = np.flatnonzero(rng.random(rows) < dirty_rate)
+    problem = rng.integers(0, 3, len(dirty))
+    start_ids[dirty[problem == 0]] = 'NULL' if era != '2021-02' else ''
+    start_lat[dirty[problem == 1]] = 0
+    start_lng[dirty[problem == 1]] = 0
+    birth_year[dirty[problem == 2]] = '\\N'
+
+    if era == '2021-02':
+        columns = [[f'{value:016X}' for value in rng.integers(0, 2 ** 62, rows)], np.full(rows, 'docked_bike'),
+                   timestamps[0], timestamps[1], start['station name'], start_ids, end['station name'], end_ids,
+                   start_lat, start_lng, end['station latitude'], end['station longitude'],
+                   np.where(usertype == 'Subscriber', 'member', 'casual')]
+    else:
+        columns = [duration, timestamps[0], timestamps[1], start_ids, start['station name'], start_lat, start_lng,
+                   end_ids, end['station name'], end['station latitude'], end['station longitude'],
+                   rng.integers(14529, 40000, rows), usertype, birth_year, rng.integers(0, 3, rows)]
+    return pd.DataFrame({name: np.asarray(values) for name, values in zip(header, columns)})
+
+
+# Function to write CSV files into a zip file, files maps each CSV file name to its df
+def write_zip(path, files):
+    with ZipFile(path, 'w', compression=ZIP_DEFLATED) as thezip:
+        for filename, df in files.items():
+            thezip.writestr(filename, df.to_csv(index=False))
+    return path
+
+
+# Function to build the GBFS station_information feed of the stations, like https://gbfs.citibikenyc.com/gbfs/en/station_information.json
+def station_information(stations):
+    return {'last_updated': int(time.time()), 'ttl': 5,
+            'data': {'stations': [{'station_id': str(row['station id']), 'name': row['station name'],
+                                   'lat': row['station latitude'], 'lon': row['station longitude'], 'capacity': 31}
+                                  for _, row in stations.iterrows()]}}
+
+
+# Function to create the status of the stations, bikes and docks add up to the 31 docks of station_information
+def make_status(stations, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'station id': stations['station id'], 'bikes': rng.integers(0, 32, len(stations)),
+                         'renting': 1, 'reported': int(time.time())})
+
+
+# Function to move bikes at a change_rate share of the stations, and to close or reopen about 1 station in 1,000
+# Returns the new status, with the time of the change as the reported time of the stations that changed
+def update_status(status, rng, change_rate=0.1):
+    status = status.copy()
+    changed = rng.random(len(status)) < change_rate
+    status.loc[changed, 'bikes'] = (status.loc[changed, 'bikes'] + rng.integers(-3, 4, changed.sum())).clip(0, 31)
+    toggled = rng.random(len(status)) < 0.001
+    status.loc[toggled, 'renting'] = 1 - status.loc[toggled, 'renting']
+    status.loc[changed | toggled, 'reported'] = int(time.time())
+    return status
+
+
+# Function to build the GBFS station_status feed of the stations, like https://gbfs.citibikenyc.com/gbfs/en/station_status.json
+def station_status(status):
+    return {'last_updated': int(time.time()), 'ttl': 5,
+            'data': {'stations': [{'station_id': str(row['station id']), 'num_bikes_available': int(row['bikes']),
+                                   'num_docks_available': 31 - int(row['bikes']), 'is_renting': int(row['renting']),
+                                   'is_returning': int(row['renting']), 'last_reported': int(row['reported'])}
+                                  for _, row in status.iterrows()]}}
+
+
+# Function to write a JSON feed, replaced atomically so a poll never reads half a file
+def write_feed(path, feed):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(feed, f)
+    os.replace(path + '.tmp', path)
+
+
+# Function to write GeoJSON files of square zip codes, neighborhoods and boroughs covering the stations, for the offline geocoder
+# Returns the [geocoder] settings pointing to them
+def write_geo(folder):
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    settings = {'mode': 'offline'}
+    for layer, prop, size in [('zipcodes', 'ZCTA5CE10', 0.01), ('neighborhoods', 'ntaname', 0.03), ('boroughs', 'boro_name', 0.06)]:
+        features = []
+        for i, lat in enumerate(np.arange(min_lat, max_lat, size)):
+            for j, lng in enumerate(np.arange(min_lng, max_lng, size)):
+                square = [[lng, lat], [lng + size, lat], [lng + size, lat + size], [lng, lat + size], [lng, lat]]
+                features.append({'type': 'Feature', 'properties': {prop: f'{layer[0].upper()}{i:02d}{j:02d}'},
+                                 'geometry': {'type': 'Polygon', 'coordinates': [square]}})
+        path = os.path.join(folder, f'{layer}.geojson')
+        with open(path, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': features}, f)
+        settings[layer] = path
+    return settings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic Citibike trip data zip files and a station feed')
+    parser.add_argument('--eras', nargs='+', default=list(eras), choices=list(eras), help='header layouts to write, one zip file each')
+    parser.add_argument('--rows', type=int, default=100000, help='rides in each zip file')
+    parser.add_argument('--stations', type=int, default=800, help='number of stations')
+    parser.add_argument('--dirty-rate', type=float, default=0.01, help='share of rides with bad station data or a missing birth year')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='./synthetic', help='folder the files are written to')
+    parser.add_argument('--status-interval', type=float, default=0,
+                        help='keep writing a new station_status.json every given seconds until stopped, 0 writes it once')
+    parser.add_argument('--change-rate', type=float, default=0.1, help='share of stations with a new status at each update')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.out):
+        os.makedirs(args.out)
+    stations = make_stations(args.stations, args.seed)
+    for era in args.eras:
+        month = era.replace('-', '')
+        trips = make_trips(stations, args.rows, era, era, args.dirty_rate, args.seed)
+        print(write_zip(os.path.join(args.out, f'{month}-citibike-tripdata.zip'), {f'{month}-citibike-tripdata.csv': trips}))
+    with open(os.path.join(args.out, 'station_information.json'), 'w') as f:
+        json.dump(station_information(stations), f)
+    write_geo(os.path.join(args.out, 'geo'))
+
+    # Serve the folder with python -m http.server to use it as a stand-in of the station_status feed
+    status = make_status(stations, args.seed)
+    write_feed(os.path.join(args.out, 'station_status.json'), station_status(status))
+    rng = np.random.default_rng(args.seed)
+    while args.status_interval > 0:
+        time.sleep(args.status_interval)
+        status = update_status(status, rng, args.change_rate)
+        write_feed(os.path.join(args.out, 'station_status.json'), station_status(status))
@@ -0,0 +1,172 @@
+import os
+import re
+import sqlite3
+
+
+# The ETL scripts talk to the warehouse through the connection/cursor API of cx_Oracle:
+# execute, executemany with batcherrors, getbatcherrors, commit and rollback
+# OracleWarehouse returns real cx_Oracle connections, SQLiteWarehouse returns a local stand-in with the same API
+# Use get_warehouse to pick one from the [warehouse] section of config.ini
+
+
+# Oracle Autonomous Data Warehouse, connected using the Wallet in ./auth and the user/pw from config.ini
+# cx_Oracle is only imported here, so the local backend runs without the Oracle Instant Client installed
+class OracleWarehouse:
+    client_ready = False
+
+    def __init__(self, config):
+        self.username = config.get('oracle', 'username')
+        self.password = config.get('oracle', 'password')
+        self.dsn = config.get('oracle', 'dsn', fallback='dwaproject_high')
+        # If using a different Oracle Client version, update the path in config.ini as needed
+        self.lib_dir = config.get('oracle', 'lib_dir', fallback='.venv/instantclient_19_10')
+
+    def connect(self):
+        import cx_Oracle
+        if not OracleWarehouse.client_ready:  # The client library can only be loaded once per process
+            cx_Oracle.init_oracle_client(lib_dir=self.lib_dir)
+            OracleWarehouse.client_ready = True
+        return cx_Oracle.connect(self.username, self.password, self.dsn)
+
+    # Converts the bind types of loader.tables to cx_Oracle types, a number is the max length of a string
+    def input_sizes(self, bind_types):
+        import cx_Oracle
+        return [cx_Oracle.DB_TYPE_NUMBER if bind_type == 'number' else bind_type for bind_type in bind_types]
+
+    # Returns the MERGE of the staging table into the table, rows are matched on key and only written when their row hash differs
+    def merge_sql(self, table, staging, key, columns, row_hash='row_hash'):
+        return (f'MERGE INTO {table} d USING {staging} s ON (d.{key} = s.{key}) '
+                f'WHEN MATCHED THEN UPDATE SET {", ".join(f"d.{column} = s.{column}" for column in columns + [row_hash] if column != key)} '
+                f'WHERE d.{row_hash} IS NULL OR d.{row_hash} <> s.{row_hash} '
+                f'WHEN NOT MATCHED THEN INSERT ({", ".join(columns + [row_hash])}) VALUES ({", ".join(f"s.{column}" for column in columns + [row_hash])})')
+
+
+# Embedded warehouse in a local SQLite file, used to profile and test the ETL without the cloud ADW
+# The star schema in create.sql is applied the first time the file is opened, followed by any other DDL files listed
+class SQLiteWarehouse:
+    def __init__(self, config):
+        self.path = config.get('warehouse', 'path', fallback='./local/warehouse.sqlite')
+        self.schema = [path.strip() for path in config.get('warehouse', 'schema', fallback='./create.sql').split(',')]
+
+    def connect(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        connection = SQLiteConnection(self.path)
+        if not connection.conn.execute("SELECT name FROM sqlite_master WHERE name = 'station_dimension' COLLATE NOCASE").fetchone():
+            for path in self.schema:
+                with open(path) as f:
+                    connection.conn.executescript(sqlite_schema(f.read()))
+        return connection
+
+    def input_sizes(self, bind_types):
+        return bind_types
+
+    # SQLite has no MERGE, an upsert does the same, the WHERE true keeps the ON CONFLICT from being parsed as a join
+    def merge_sql(self, table, staging, key, columns, row_hash='row_hash'):
+        return (f'INSERT INTO {table} ({", ".join(columns + [row_hash])}) SELECT {", ".join(columns + [row_hash])} FROM {staging} WHERE true '
+                f'ON CONFLICT ({key}) DO UPDATE SET {", ".join(f"{column} = excluded.{column}" for column in columns + [row_hash] if column != key)} '
+                f'WHERE {table}.{row_hash} IS NOT excluded.{row_hash}')
+
+
+def get_warehouse(config):
+    backend = config.get('warehouse', 'backend', fallback='oracle')  # oracle or sqlite
+    if backend == 'sqlite':
+        return SQLiteWarehouse(config)
+    return OracleWarehouse(config)
+
+
+# Function to convert the Oracle DDL in create.sql to SQLite
+# An INTEGER primary key is an alias of the SQLite rowid, which gives the same auto-generated ids as an IDENTITY column
+# Global temporary tables become regular tables, the ETL empties them before use
+def sqlite_schema(ddl):
+    ddl = re.sub(r'number\s+GENERATED BY DEFAULT ON NULL AS IDENTITY', 'INTEGER', ddl, flags=re.IGNORECASE)
+    ddl = re.sub(r'GLOBAL\s+TEMPORARY\s+TABLE', 'TABLE', ddl, flags=re.IGNORECASE)
+    ddl = re.sub(r'\)\s*ON COMMIT (DELETE|PRESERVE) ROWS', ')', ddl, flags=re.IGNORECASE)
+    return re.sub(r'varchar2', 'varchar', ddl, flags=re.IGNORECASE)
+
+
+# Function to convert the Oracle SQL used by the ETL scripts to SQLite
+# The admin schema is dropped and positional binds :1, :2 become ?1, ?2
+def sqlite_sql(sql):
+    sql = re.sub(r'\badmin\.', '', sql, flags=re.IGNORECASE)
+    return re.sub(r':(\d+)', r'?\1', sql)
+
+
+# Same attributes as a cx_Oracle batch error, used by BulkLoader and log_error
+class BatchError:
+    def __init__(self, message, offset):
+        self.message = message
+        self.offset = offset
+
+
+class SQLiteConnection:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute('PRAGMA foreign_keys = ON')  # SQLite only checks foreign keys when asked to, Oracle always does
+
+    def cursor(self):
+        return SQLiteCursor(self)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+class SQLiteCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.conn.cursor()
+        self.batcherrors = []
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, parameters=(), **kwargs):
+        self.cursor.execute(sqlite_sql(sql), kwargs or parameters)
+        return self
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    # With batcherrors=True, failing rows are recorded instead of raised, like cx_Oracle
+    # The good rows stay inserted in the open transaction, so the caller can still commit or roll back the whole batch
+    def executemany(self, sql, data, batcherrors=False):
+        sql = sqlite_sql(sql)
+        self.batcherrors = []
+        if not batcherrors:
+            self.cursor.executemany(sql, data)
+            return
+
+        if not self.connection.conn.in_transaction:
+            self.cursor.execute('BEGIN')
+        self.cursor.execute('SAVEPOINT batch')
+        try:
+            self.cursor.executemany(sql, data)
+        except sqlite3.DatabaseError:
+            # SQLite stops at the first bad row, so the batch is replayed one row at a time to find them all
+            self.cursor.execute('ROLLBACK TO batch')
+            for offset, row in enumerate(data):
+                try:
+                    self.cursor.execute(sql, row)
+                except sqlite3.DatabaseError as e:
+                    self.batcherrors.append(BatchError(str(e), offset))
+        self.cursor.execute('RELEASE batch')
+
+    def getbatcherrors(self):
+        return self.batcherrors
+
+    # Bind types only matter to cx_Oracle, SQLite is dynamically typed
+    def setinputsizes(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        self.cursor.close()